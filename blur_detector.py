@@ -4,8 +4,37 @@ Marichal, Xavier & Ma, Wei-Ying & Zhang, HongJiang. (1999). Blur determination
 in the compressed domain using DCT information. IEEE International Conference on
 Image Processing. 2. 386 - 390 vol.2. 10.1109/ICIP.1999.822923. 
 """
+import csv
+import os
+import time
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
 import cv2
 import numpy as np
+from tqdm import tqdm
+
+from file_list_generator import ListGenerator
+from jpeg_coefficients import read_luma_coefficients
+
+# Coefficients this close to the threshold are double checked by cv2.dct.
+DCT_TOLERANCE = 1e-2
+
+# DCT basis matrices cached by block size.
+_DCT_BASIS = {}
+
+# Flags of decoding images in reduced size, by the reduce factor.
+REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE,
+                     2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                     4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# Image formats to be scored in batch mode.
+IMAGE_FORMATS = ['jpg', 'jpeg', 'png', 'bmp']
+
+# The detector of the current worker process in batch mode.
+_DETECTOR = None
+_COMPRESSED_DOMAIN = False
 
 
 class BlurDetector(object):
@@ -53,20 +82,58 @@ class BlurDetector(object):
 
         return result, image
 
-    def get_blurness(self, image, block_size=8):
-        """Estimate the blurness of an image.
+    def get_dct_histogram(self, image, block_size=8):
+        """Count the non-zero DCT coefficients of all the blocks in image.
         Args:
-            image: image as a numpy array of shape [height, width, channels].
-            block_size: the size of the minimal DCT block size.
+            image: grayscale image as a numpy array of shape [height, width].
+            block_size: the size of the minimal DCT block.
         Returns:
-            a float value represents the blurness.
+            hist: a 2D histogram of shape [block_size, block_size].
+        """
+        blocks = split_blocks(image, block_size)
+        return self.get_none_zero_masks(blocks).sum(axis=0)
+
+    def get_none_zero_masks(self, blocks):
+        """Find the non-zero DCT coefficients of every block.
+
+        All the blocks are transformed at once as a pair of matrix products
+        with a precomputed DCT basis. Coefficients lying too close to the
+        threshold are double checked with cv2.dct so the result is exactly
+        the same as the one from the block by block loop.
+
+        Args:
+            blocks: image blocks of shape [blocks, block_size, block_size].
+        Returns:
+            boolean masks of the same shape as blocks.
+        """
+        blocks = np.float32(blocks)
+
+        # DCT of all blocks: C * X * C^T.
+        basis = get_dct_basis(blocks.shape[-1])
+        spectrum = np.abs(np.matmul(np.matmul(basis, blocks), basis.T))
+        none_zero = spectrum > self.dct_threshold
+
+        # Blocks with coefficients on the edge of the threshold are recomputed
+        # in float32 exactly as cv2.dct does.
+        suspects = np.abs(spectrum - self.dct_threshold) < DCT_TOLERANCE
+        for index in np.flatnonzero(suspects.any(axis=(1, 2))):
+            patch_spectrum = cv2.dct(blocks[index])
+            none_zero[index] = np.abs(patch_spectrum) > self.dct_threshold
+
+        return none_zero
+
+    def get_dct_histogram_by_loop(self, image, block_size=8):
+        """Count the non-zero DCT coefficients block by block. This is the
+        reference implementation of get_dct_histogram.
+        Args:
+            image: grayscale image as a numpy array of shape [height, width].
+            block_size: the size of the minimal DCT block.
+        Returns:
+            hist: a 2D histogram of shape [block_size, block_size].
         """
         # A 2D histogram.
         hist = np.zeros((8, 8), dtype=int)
 
-        # Only the illumination is considered in blur.
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
         # Split the image into patches and do DCT on the image patch.
         height, width = image.shape
         round_v = int(height / block_size)
@@ -84,16 +151,461 @@ class BlurDetector(object):
                 patch_none_zero = np.abs(patch_spectrum) > self.dct_threshold
                 hist += patch_none_zero.astype(int)
 
+        return hist
+
+    def get_blurness_from_hist(self, hist):
+        """Get the blurness from a DCT histogram.
+        Args:
+            hist: a 2D histogram of shape [8, 8].
+        Returns:
+            a float value represents the blurness.
+        """
         _blur = hist < self.max_hist * hist[0, 0]
         _blur = (np.multiply(_blur.astype(int), self.hist_weight)).sum()
         return _blur/self.weight_total
 
+    def get_blurness(self, image, block_size=8):
+        """Estimate the blurness of an image.
+        Args:
+            image: image as a numpy array of shape [height, width, channels],
+                or a grayscale image of shape [height, width].
+            block_size: the size of the minimal DCT block size.
+        Returns:
+            a float value represents the blurness.
+        """
+        # Only the illumination is considered in blur.
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        hist = self.get_dct_histogram(image, block_size)
+        return self.get_blurness_from_hist(hist)
+
+    def get_blurness_from_coefficients(self, coefficients):
+        """Estimate the blurness from the DCT coefficients of a JPEG file.
+        Args:
+            coefficients: the luminance DCT coefficients of shape
+                [block rows, block columns, 8, 8].
+        Returns:
+            a float value represents the blurness.
+        """
+        none_zero = np.abs(coefficients.reshape(-1, 8, 8)) > self.dct_threshold
+        return self.get_blurness_from_hist(none_zero.sum(axis=0))
+
+    def get_blurness_from_file(self, image_file, compressed_domain=False):
+        """Estimate the blurness of an image file.
+
+        In compressed domain the DCT coefficients are read from baseline JPEG
+        files directly, skipping the pixel decoding and the forward DCT. Other
+        files, or files could not be read, fall back to the pixel domain. The
+        decoder is written in pure Python and is slower than the pixel domain.
+
+        Args:
+            image_file: the image file url.
+            compressed_domain: use the DCT coefficients stored in JPEG files.
+        Returns:
+            a float value represents the blurness, or None if the file could
+            not be read.
+        """
+        if compressed_domain:
+            coefficients = read_luma_coefficients(image_file)
+            if coefficients is not None:
+                return self.get_blurness_from_coefficients(coefficients)
+
+        image = cv2.imread(image_file)
+        if image is None:
+            return None
+        _, image = self.check_image_size(image)
+        return self.get_blurness(image)
+
+    def get_blurness_of_boxes(self, image, boxes, scale=1.0, block_size=8):
+        """Estimate the blurness of the regions in boxes only.
+        Args:
+            image: image as a numpy array, color or grayscale.
+            boxes: a list of boxes [left_x, top_y, right_x, bottom_y], like
+                the ones from face_detector.get_facebox.
+            scale: the size of image divided by the size of the image the
+                boxes come from, i.e. 1/4 for an image read with
+                cv2.IMREAD_REDUCED_GRAYSCALE_4.
+            block_size: the size of the minimal DCT block size.
+        Returns:
+            a list of blurness, None for boxes out of image or too small.
+        """
+        rows, cols = image.shape[:2]
+        results = []
+        for box in boxes:
+            left_x = max(int(box[0] * scale), 0)
+            top_y = max(int(box[1] * scale), 0)
+            right_x = min(int(box[2] * scale), cols)
+            bottom_y = min(int(box[3] * scale), rows)
+            if right_x - left_x < block_size or bottom_y - top_y < block_size:
+                results.append(None)
+                continue
+            _, region = self.check_image_size(
+                image[top_y:bottom_y, left_x:right_x], block_size)
+            results.append(self.get_blurness(region, block_size))
+        return results
+
+    def get_blurness_of_file_boxes(self, image_file, boxes, reduce_factor=1):
+        """Estimate the blurness of the regions in boxes of an image file.
+        Args:
+            image_file: the image file url.
+            boxes: a list of boxes in the full resolution image.
+            reduce_factor: 1, 2, 4 or 8. Large images could be decoded in
+                reduced size to save time. Blurness of different factors are
+                not comparable, as downscaling makes the image sharper.
+        Returns:
+            a list of blurness, or None if the file could not be read.
+        """
+        image = cv2.imread(image_file, REDUCED_GRAYSCALE[reduce_factor])
+        if image is None:
+            return None
+        return self.get_blurness_of_boxes(image, boxes, 1.0 / reduce_factor)
+
+
+class BlurMonitor(object):
+    """Track the blurness of video frames incrementally.
+
+    The non-zero DCT masks of all blocks are kept between frames. Only the
+    blocks whose pixels changed more than a threshold since they were last
+    transformed are transformed again, and the histogram is updated by the
+    difference. On mostly static footage only a small part of the frame is
+    transformed every time.
+    """
+
+    def __init__(self, change_threshold=2.0, block_size=8):
+        """Initialize the monitor.
+        Args:
+            change_threshold: a block is transformed again if the mean absolute
+                difference of its pixels exceeds this value. Setting it to 0
+                gives the same result as scoring every frame in full.
+            block_size: the size of the minimal DCT block.
+        """
+        self.detector = BlurDetector()
+        self.change_threshold = change_threshold
+        self.block_size = block_size
+
+        # The blocks at their last transform, their masks and the histogram.
+        self.blocks = None
+        self.masks = None
+        self.hist = None
+
+        # How many blocks have been transformed, and how many have been seen.
+        self.transformed = 0
+        self.total = 0
+
+    def reset(self):
+        """Forget the last frame, i.e. on a scene cut."""
+        self.blocks = None
+
+    def update(self, frame):
+        """Update the monitor with a new frame.
+        Args:
+            frame: the video frame, color or grayscale.
+        Returns:
+            the blurness of this frame.
+        """
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        _, frame = self.detector.check_image_size(frame, self.block_size)
+        blocks = split_blocks(frame, self.block_size)
+
+        if self.blocks is None or self.blocks.shape != blocks.shape:
+            self.blocks = blocks.copy()
+            self.masks = self.detector.get_none_zero_masks(blocks)
+            self.hist = self.masks.sum(axis=0)
+            changed = np.arange(len(blocks))
+        else:
+            diff = np.abs(np.int16(blocks) - self.blocks)
+            changed = np.flatnonzero(
+                diff.mean(axis=(1, 2)) > self.change_threshold)
+            if len(changed):
+                masks = self.detector.get_none_zero_masks(blocks[changed])
+                self.hist -= self.masks[changed].sum(axis=0)
+                self.hist += masks.sum(axis=0)
+                self.masks[changed] = masks
+                self.blocks[changed] = blocks[changed]
+
+        self.transformed += len(changed)
+        self.total += len(blocks)
+
+        return self.detector.get_blurness_from_hist(self.hist)
+
+    def run(self, video):
+        """Track the blurness of all frames in a video.
+        Args:
+            video: a video file url, a camera index, or a cv2.VideoCapture.
+        Yields:
+            the blurness of every frame.
+        """
+        cap = video
+        if not isinstance(video, cv2.VideoCapture):
+            cap = cv2.VideoCapture(video)
+        self.reset()
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield self.update(frame)
+
+
+def get_reduce_factor(boxes, min_size=64):
+    """Get the largest reduce factor that keeps all boxes large enough.
+    Args:
+        boxes: a list of boxes [left_x, top_y, right_x, bottom_y].
+        min_size: the minimal box side length after reduction.
+    Returns:
+        the reduce factor, one of 1, 2, 4 and 8.
+    """
+    if len(boxes) == 0:
+        return 1
+    side = min(min(box[2] - box[0], box[3] - box[1]) for box in boxes)
+    for factor in (8, 4, 2):
+        if side / factor >= min_size:
+            return factor
+    return 1
+
+
+def split_blocks(image, block_size=8):
+    """Split an image into blocks. Pixels not filling a whole block are
+    ignored.
+    Args:
+        image: grayscale image as a numpy array of shape [height, width].
+        block_size: the size of the blocks.
+    Returns:
+        the blocks as a numpy array of shape [blocks, block_size, block_size].
+    """
+    height, width = image.shape
+    round_v = int(height / block_size)
+    round_h = int(width / block_size)
+    blocks = image[:round_v * block_size, :round_h * block_size]
+    blocks = blocks.reshape(round_v, block_size, round_h, block_size)
+    return blocks.swapaxes(1, 2).reshape(-1, block_size, block_size)
+
+
+def get_dct_basis(block_size=8):
+    """Get the orthonormal DCT-II basis matrix, the same one cv2.dct uses.
+    Args:
+        block_size: the size of the DCT block.
+    Returns:
+        a numpy array of shape [block_size, block_size].
+    """
+    if block_size not in _DCT_BASIS:
+        k = np.arange(block_size).reshape(-1, 1)
+        n = np.arange(block_size).reshape(1, -1)
+        basis = np.cos(np.pi * (2 * n + 1) * k / (2 * block_size))
+        basis *= np.sqrt(2.0 / block_size)
+        basis[0, :] /= np.sqrt(2.0)
+        _DCT_BASIS[block_size] = np.float32(basis)
+    return _DCT_BASIS[block_size]
+
+
+def benchmark(sizes=((240, 320), (480, 640), (720, 1280), (1080, 1920)),
+              repeat=3):
+    """Compare the vectorized DCT histogram with the block by block loop.
+    Args:
+        sizes: a list of image sizes (height, width) to test.
+        repeat: how many times each method runs for every size.
+    """
+    bd = BlurDetector()
+    for height, width in sizes:
+        # Smoothed noise looks more like a natural image than pure noise.
+        image = np.random.randint(0, 256, (height, width), dtype=np.uint8)
+        image = cv2.GaussianBlur(image, (5, 5), 0)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            hist_loop = bd.get_dct_histogram_by_loop(image)
+        time_loop = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            hist_vec = bd.get_dct_histogram(image)
+        time_vec = (time.perf_counter() - start) / repeat
+
+        assert np.array_equal(hist_loop, hist_vec), "Histograms mismatch."
+        print("{}x{}: loop {:.2f} ms, vectorized {:.2f} ms, speedup {:.1f}x".format(
+            width, height, time_loop * 1000, time_vec * 1000, time_loop / time_vec))
+
+
+def benchmark_monitor(size=(720, 1280), frames=100, change_threshold=2.0):
+    """Compare the incremental monitor with full scoring of every frame, on
+    a static synthetic scene with a small moving object.
+    Args:
+        size: the frame size (height, width).
+        frames: number of frames.
+        change_threshold: the change threshold of the monitor.
+    """
+    height, width = size
+    background = np.random.randint(0, 256, (height, width), dtype=np.uint8)
+    background = cv2.GaussianBlur(background, (5, 5), 0)
+    video = []
+    for i in range(frames):
+        frame = background.copy()
+        x = (i * 7) % (width - 64)
+        cv2.rectangle(frame, (x, height // 2), (x + 64, height // 2 + 64),
+                      255, -1)
+        video.append(frame)
 
-if __name__ == "__main__":
     bd = BlurDetector()
-    image = cv2.imread('/home/robin/Desktop/face.jpg')
+    start = time.perf_counter()
+    full = [bd.get_blurness(frame) for frame in video]
+    time_full = time.perf_counter() - start
+
+    monitor = BlurMonitor(change_threshold)
+    start = time.perf_counter()
+    tracked = [monitor.update(frame) for frame in video]
+    time_tracked = time.perf_counter() - start
+
+    print("Full: {:.1f} FPS, incremental: {:.1f} FPS, speedup {:.1f}x".format(
+        frames / time_full, frames / time_tracked, time_full / time_tracked))
+    print("Blocks transformed: {:.1%}, max blurness error: {:.4f}".format(
+        monitor.transformed / monitor.total,
+        np.max(np.abs(np.array(full) - np.array(tracked)))))
+
+
+def read_image_list(target):
+    """Get the image files to be scored.
+    Args:
+        target: a directory, or a CSV list saved by ListGenerator.
+    Returns:
+        a list of image file urls.
+    """
+    if os.path.isdir(target):
+        lg = ListGenerator()
+        return lg.generate_list(target, IMAGE_FORMATS)
+
+    with open(target, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        return [row['file_url'] for row in reader]
+
+
+def _init_worker(compressed_domain=False):
+    """Every worker process holds its own detector."""
+    global _DETECTOR, _COMPRESSED_DOMAIN
+    _DETECTOR = BlurDetector()
+    _COMPRESSED_DOMAIN = compressed_domain
+    # Processes already run in parallel, keep OpenCV single threaded.
+    cv2.setNumThreads(1)
+
+
+def _score_image(task):
+    """Score one image in a worker process.
+    Args:
+        task: a tuple of (index, image file url).
+    Returns:
+        (index, image file url, blurness). The blurness is NaN if the image
+        could not be read.
+    """
+    index, image_file = task
+    blurness = _DETECTOR.get_blurness_from_file(image_file, _COMPRESSED_DOMAIN)
+    if blurness is None:
+        blurness = float('nan')
+    return index, image_file, blurness
+
+
+def score_images(image_files, output_file, num_workers=None, ordered=True,
+                 chunk_size=64, compressed_domain=False):
+    """Score a list of images with a process pool and stream the results to
+    disk as soon as they are ready.
+
+    Args:
+        image_files: a list of image file urls.
+        output_file: a .csv file of (file_url, blurness) rows, or a .npy file
+            of blurness values in the same order of image_files. In the later
+            case the file urls are saved in a .txt file along with it.
+        num_workers: number of worker processes, default to the CPU count.
+        ordered: write the results in the order of image_files.
+        chunk_size: number of images sent to a worker in one task.
+        compressed_domain: read the DCT coefficients from JPEG files directly,
+            slower than decoding the pixels.
+
+    Returns:
+        the processing speed in images per second.
+    """
+    tasks = enumerate(image_files)
+    start = time.perf_counter()
+
+    with Pool(num_workers, initializer=_init_worker,
+              initargs=(compressed_domain,)) as pool:
+        if ordered:
+            results = pool.imap(_score_image, tasks, chunk_size)
+        else:
+            results = pool.imap_unordered(_score_image, tasks, chunk_size)
+        results = tqdm(results, total=len(image_files))
+
+        if output_file.endswith('.npy'):
+            # A memory mapped array could be filled in any order.
+            scores = np.lib.format.open_memmap(
+                output_file, mode='w+', dtype=np.float32,
+                shape=(len(image_files),))
+            for index, _, blurness in results:
+                scores[index] = blurness
+            scores.flush()
+            del scores
+
+            name_file = os.path.splitext(output_file)[0] + '.txt'
+            with open(name_file, 'w') as fid:
+                fid.writelines(url + '\n' for url in image_files)
+        else:
+            with open(output_file, 'w', newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(['file_url', 'blurness'])
+                for _, image_file, blurness in results:
+                    writer.writerow([image_file, blurness])
+
+    speed = len(image_files) / (time.perf_counter() - start)
+    print("{} images scored, {:.1f} images/sec.".format(
+        len(image_files), speed))
+
+    return speed
+
+
+def main():
+    """The main entrance"""
+    parser = ArgumentParser()
+    parser.add_argument('--image', type=str, default='/home/robin/Desktop/face.jpg',
+                        help='the image to be checked')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='benchmark the DCT engine on random images')
+    parser.add_argument('--video', type=str, default=None,
+                        help='a video file to be tracked frame by frame')
+    parser.add_argument('--batch', type=str, default=None,
+                        help='a directory or a CSV file list to be scored')
+    parser.add_argument('--output', type=str, default='blurness.csv',
+                        help='where the batch results go, .csv or .npy')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--unordered', action='store_true',
+                        help='write batch results as soon as they finish')
+    parser.add_argument('--compressed', action='store_true',
+                        help='score JPEG files by their stored DCT coefficients, slow')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+        benchmark_monitor()
+        return
+
+    if args.video:
+        monitor = BlurMonitor()
+        for index, blurness in enumerate(monitor.run(args.video)):
+            print("Frame {}: {:.2f}".format(index, blurness))
+        return
+
+    if args.batch:
+        image_files = read_image_list(args.batch)
+        score_images(image_files, args.output, args.workers,
+                     ordered=not args.unordered,
+                     compressed_domain=args.compressed)
+        return
+
+    bd = BlurDetector()
+    image = cv2.imread(args.image)
     result, image = bd.check_image_size(image)
     if not result:
         print("Image expanded.")
     blur = bd.get_blurness(image)
     print("Blurness: {:.2f}".format(blur))
+
+
+if __name__ == "__main__":
+    main()
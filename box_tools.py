@@ -0,0 +1,166 @@
+"""
+Array versions of the box helpers in pts_tools. They work on a batch of boxes
+of shape (N, 4) as [left_x, top_y, right_x, bottom_y] and points of shape
+(N, K, 2), with the same integer rounding as the single box functions.
+
+Image sizes are given as rows and cols, either numbers shared by all boxes or
+arrays of shape (N,).
+"""
+import numpy as np
+
+
+def _split(boxes):
+    """Split boxes into four int64 columns."""
+    boxes = np.asarray(boxes, dtype=np.int64)
+    return boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+
+
+def get_minimal_box(points):
+    """
+    Get the minimal bounding boxes of groups of points.
+    The coordinates are truncated to int numbers like int() does.
+    """
+    points = np.asarray(points)
+    min_xy = np.trunc(points.min(axis=1)).astype(np.int64)
+    max_xy = np.trunc(points.max(axis=1)).astype(np.int64)
+    return np.stack([min_xy[:, 0], min_xy[:, 1], max_xy[:, 0], max_xy[:, 1]],
+                    axis=1)
+
+
+def get_square_box(boxes):
+    """Get the square boxes which are ready for CNN from the boxes"""
+    left_x, top_y, right_x, bottom_y = _split(boxes)
+
+    diff = (bottom_y - top_y) - (right_x - left_x)
+    delta = np.abs(diff) // 2
+    odd = (diff % 2 == 1).astype(np.int64)
+
+    slim = diff > 0                 # Height > width, a slim box.
+    short = diff < 0                # Width > height, a short box.
+    left_x = np.where(slim, left_x - delta, left_x)
+    right_x = np.where(slim, right_x + delta + odd, right_x)
+    top_y = np.where(short, top_y - delta, top_y)
+    bottom_y = np.where(short, bottom_y + delta + odd, bottom_y)
+
+    return np.stack([left_x, top_y, right_x, bottom_y], axis=1)
+
+
+def move_box(boxes, offsets):
+    """Move the boxes to directions specified by offsets of shape (N, 2)"""
+    offsets = np.broadcast_to(np.asarray(offsets, dtype=np.int64),
+                              (len(boxes), 2))
+    return np.asarray(boxes, dtype=np.int64) + np.tile(offsets, 2)
+
+
+def expand_box(square_boxes, scale_ratio=1.2):
+    """Scale up the boxes"""
+    assert (scale_ratio >= 1), "Scale ratio should be greater than 1."
+    left_x, top_y, right_x, bottom_y = _split(square_boxes)
+    delta = np.trunc((right_x - left_x) * (scale_ratio - 1) / 2).astype(np.int64)
+    return np.stack([left_x - delta, top_y - delta,
+                     right_x + delta, bottom_y + delta], axis=1)
+
+
+def points_in_box(points, boxes):
+    """Check if each box contains all of its points"""
+    minimal_boxes = get_minimal_box(points)
+    boxes = np.asarray(boxes)
+    return (boxes[:, :2] <= minimal_boxes[:, :2]).all(axis=1) & \
+        (boxes[:, 2:] >= minimal_boxes[:, 2:]).all(axis=1)
+
+
+def box_in_image(boxes, rows, cols):
+    """Check if the boxes are in image"""
+    left_x, top_y, right_x, bottom_y = _split(boxes)
+    return (left_x >= 0) & (top_y >= 0) & (right_x <= cols) & (bottom_y <= rows)
+
+
+def box_is_valid(boxes, points, rows, cols):
+    """Check if boxes are valid: square, in image and containing the points."""
+    left_x, top_y, right_x, bottom_y = _split(boxes)
+    w_equal_h = (right_x - left_x) == (bottom_y - top_y)
+    return box_in_image(boxes, rows, cols) & points_in_box(points, boxes) & \
+        w_equal_h
+
+
+def fit_by_shifting(boxes, rows, cols):
+    """Method 1: Try to move the boxes."""
+    left_x, top_y, right_x, bottom_y = _split(boxes)
+
+    # Check if moving is possible.
+    movable = (right_x - left_x <= cols) & (bottom_y - top_y <= rows)
+
+    crossed = movable & (left_x < 0)            # Move right.
+    right_x = np.where(crossed, right_x - left_x, right_x)
+    left_x = np.where(crossed, 0, left_x)
+    crossed = movable & (right_x > cols)        # Move left.
+    left_x = np.where(crossed, left_x - (right_x - cols), left_x)
+    right_x = np.where(crossed, cols, right_x)
+    crossed = movable & (top_y < 0)             # Move down.
+    bottom_y = np.where(crossed, bottom_y - top_y, bottom_y)
+    top_y = np.where(crossed, 0, top_y)
+    crossed = movable & (bottom_y > rows)       # Move up.
+    top_y = np.where(crossed, top_y - (bottom_y - rows), top_y)
+    bottom_y = np.where(crossed, rows, bottom_y)
+
+    return np.stack([left_x, top_y, right_x, bottom_y], axis=1)
+
+
+def fit_by_shrinking(boxes, rows, cols):
+    """Method 2: Try to shrink the boxes."""
+    left_x, top_y, right_x, bottom_y = _split(boxes)
+
+    # The first step would be get the interlaced area.
+    left_x = np.maximum(left_x, 0)
+    top_y = np.maximum(top_y, 0)
+    right_x = np.minimum(right_x, cols)
+    bottom_y = np.minimum(bottom_y, rows)
+
+    # Then shrink the larger one of width and height.
+    width = right_x - left_x
+    height = bottom_y - top_y
+    delta = np.abs(width - height)
+    half = delta // 2
+    rest = delta % 2
+
+    alter_x = width > height
+    center = alter_x & (left_x != 0) & (right_x != cols)
+    from_right = alter_x & ~center & (left_x == 0)
+    from_left = alter_x & ~center & ~from_right
+    new_left_x = np.where(center, left_x + half,
+                          np.where(from_left, left_x + delta, left_x))
+    new_right_x = np.where(center, right_x - half - rest,
+                           np.where(from_right, right_x - delta, right_x))
+
+    alter_y = ~alter_x
+    center = alter_y & (top_y != 0) & (bottom_y != rows)
+    from_bottom = alter_y & ~center & (top_y == 0)
+    from_top = alter_y & ~center & ~from_bottom
+    new_top_y = np.where(center, top_y + half + rest,
+                         np.where(from_top, top_y + delta, top_y))
+    new_bottom_y = np.where(center, bottom_y - half,
+                            np.where(from_bottom, bottom_y - delta, bottom_y))
+
+    return np.stack([new_left_x, new_top_y, new_right_x, new_bottom_y], axis=1)
+
+
+def fit_box(boxes, points, rows, cols):
+    """
+    Try to fit the boxes, make sure they satisfy following conditions:
+    - A square.
+    - Inside the image.
+    - Contains all the points.
+    Return the fitted boxes and a boolean array telling which ones succeeded.
+    The boxes failed are returned as they were.
+    """
+    boxes = np.asarray(boxes, dtype=np.int64)
+
+    # First try to move the boxes, then try to shrink.
+    boxes_moved = fit_by_shifting(boxes, rows, cols)
+    moved_valid = box_is_valid(boxes_moved, points, rows, cols)
+    boxes_shrunken = fit_by_shrinking(boxes, rows, cols)
+    shrunken_valid = box_is_valid(boxes_shrunken, points, rows, cols)
+
+    result = np.where(moved_valid[:, None], boxes_moved,
+                      np.where(shrunken_valid[:, None], boxes_shrunken, boxes))
+    return result, moved_valid | shrunken_valid
@@ -0,0 +1,228 @@
+"""
+This script renders the landmarks, face boxes and pose axes of many samples
+into contact sheets without any window, so a data set could be reviewed on a
+headless server. Samples are rendered in parallel and the sheets are written
+as images or as frames of a video by a background encoder thread.
+"""
+import json
+import os
+import queue
+import random
+import threading
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+import face_detector as fd
+import pose_estimator as pe
+import pts_tools as pt
+from blur_detector import BlurDetector
+from file_list_generator import ListGenerator
+
+TILE_SIZE = 256
+
+
+def get_image_file(json_file, image_dir=pt.IMAGE_DIR):
+    """Get the image of a landmark JSON file, the same as preview_json."""
+    _, tail = os.path.split(json_file)
+    return os.path.join(image_dir, tail.split('.')[-2] + ".jpg")
+
+
+def render_sample(json_file, tile_size=TILE_SIZE, image_dir=pt.IMAGE_DIR):
+    """
+    Render one sample as a tile with its landmarks, minimal face box and pose.
+    Return the tile, or a gray tile if the image could not be read.
+    """
+    tile = np.full((tile_size, tile_size, 3), 64, dtype=np.uint8)
+    image = cv2.imread(get_image_file(json_file, image_dir))
+    if image is None:
+        cv2.putText(tile, "missing", (10, tile_size // 2),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255))
+        return tile
+    tile = cv2.resize(image, (tile_size, tile_size))
+
+    with open(json_file, 'r') as f:
+        marks = np.reshape(json.load(f), (-1, 2)) * tile_size
+
+    # Draw the face box and the landmarks.
+    fd.draw_box(tile, [pt.get_minimal_box(marks)], box_color=(0, 255, 0),
+                line_width=1)
+    for mark in marks.astype(int).tolist():
+        cv2.circle(tile, tuple(mark), 1, (0, 255, 0), -1, cv2.LINE_AA)
+
+    # Draw the pose.
+    estimator = pe.PoseEstimator(img_size=(tile_size, tile_size))
+    r_vecs, t_vecs = estimator.solve_pose_by_68_points_batch(marks[None])
+    estimator.draw_axis(tile, r_vecs[0], t_vecs[0])
+
+    # And the sample name.
+    name = os.path.basename(json_file).split('.')[-2]
+    cv2.putText(tile, name[-24:], (4, tile_size - 6),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255))
+    return tile
+
+
+def _get_blurness(json_file, image_dir=pt.IMAGE_DIR):
+    """Get the blurness of the image of a sample, NaN if not readable."""
+    blurness = BlurDetector().get_blurness_from_file(
+        get_image_file(json_file, image_dir))
+    return float('nan') if blurness is None else blurness
+
+
+def select_samples(json_files, mode='every', count=10000, seed=0,
+                   num_workers=None, image_dir=pt.IMAGE_DIR):
+    """
+    Select the samples to be reviewed.
+    mode: 'random' for a random subset, 'every' for every Nth sample, or
+        'blur' for the most blurry ones first.
+    count: the maximum number of samples selected.
+    """
+    if mode == 'random':
+        rng = random.Random(seed)
+        return rng.sample(json_files, min(count, len(json_files)))
+
+    if mode == 'every':
+        step = max(len(json_files) // count, 1)
+        return json_files[::step][:count]
+
+    # The most blurry first, unreadable images are left to the end.
+    with Pool(num_workers) as pool:
+        blurness = pool.map(partial(_get_blurness, image_dir=image_dir),
+                            json_files, chunksize=64)
+    blurness = np.nan_to_num(np.array(blurness), nan=-1.0)
+    order = np.argsort(-blurness, kind='stable')[:count]
+    return [json_files[i] for i in order]
+
+
+def _put(sheet_queue, item, stop):
+    """Put an item into the queue unless stopped. Return False if stopped."""
+    while not stop.is_set():
+        try:
+            sheet_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _write_sheets(sheet_queue, writer, image_name, stop, errors):
+    """Encode the sheets from the queue until None is received. On failure
+    the exception is recorded and the producer is stopped."""
+    index = 0
+    try:
+        while not stop.is_set():
+            try:
+                sheet = sheet_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if sheet is None:
+                break
+            if writer is not None:
+                writer.write(sheet)
+            else:
+                image_file = image_name.format(index)
+                if not cv2.imwrite(image_file, sheet):
+                    raise IOError("Can not write {}".format(image_file))
+            index += 1
+    except Exception as error:
+        errors.append(error)
+        stop.set()
+
+
+def render_sheets(json_files, output, columns=10, rows=10,
+                  tile_size=TILE_SIZE, num_workers=None, image_dir=pt.IMAGE_DIR):
+    """
+    Render the samples into contact sheets of columns x rows tiles.
+    output: a .mp4 video with one sheet per frame, or an image name, i.e.
+        sheet.jpg, to which the sheet number is appended.
+    """
+    # Make sure the output could be written before any rendering.
+    writer = None
+    image_name = None
+    if output.endswith('.mp4'):
+        writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*'mp4v'), 2,
+                                 (columns * tile_size, rows * tile_size))
+        if not writer.isOpened():
+            raise IOError("Can not open video writer for {}".format(output))
+    else:
+        name, ext = os.path.splitext(output)
+        image_name = name + "-{:04d}" + (ext or '.jpg')
+        if not cv2.haveImageWriter(image_name.format(0)):
+            raise ValueError("Unsupported image format: {}".format(output))
+
+    sheet_queue = queue.Queue(4)
+    stop = threading.Event()
+    errors = []
+    encoder = threading.Thread(target=_write_sheets,
+                               args=(sheet_queue, writer, image_name, stop,
+                                     errors))
+    encoder.start()
+
+    per_sheet = columns * rows
+    blank = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+    tiles = []
+
+    def _flush(tiles):
+        tiles = tiles + [blank] * (per_sheet - len(tiles))
+        lines = [np.hstack(tiles[i:i + columns])
+                 for i in range(0, per_sheet, columns)]
+        return _put(sheet_queue, np.vstack(lines), stop)
+
+    try:
+        with Pool(num_workers) as pool:
+            render = partial(render_sample, tile_size=tile_size,
+                             image_dir=image_dir)
+            for tile in tqdm(pool.imap(render, json_files, chunksize=16),
+                             total=len(json_files)):
+                tiles.append(tile)
+                if len(tiles) == per_sheet:
+                    if not _flush(tiles):
+                        break
+                    tiles = []
+        if tiles and not stop.is_set():
+            _flush(tiles)
+    finally:
+        _put(sheet_queue, None, stop)
+        encoder.join()
+        if writer is not None:
+            writer.release()
+
+    if errors:
+        raise errors[0]
+
+
+def main():
+    """The main entrance"""
+    parser = ArgumentParser()
+    parser.add_argument('--mark_dir', type=str, default=pt.MARK_DIR,
+                        help='where the landmark JSON files are')
+    parser.add_argument('--image_dir', type=str, default=pt.IMAGE_DIR,
+                        help='where the sample images are')
+    parser.add_argument('--output', type=str, default='sheet.jpg',
+                        help='a .mp4 video or the image name of the sheets')
+    parser.add_argument('--mode', type=str, default='every',
+                        choices=['random', 'every', 'blur'],
+                        help='how the samples are selected')
+    parser.add_argument('--count', type=int, default=10000,
+                        help='the maximum number of samples')
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes')
+    args = parser.parse_args()
+
+    lg = ListGenerator()
+    json_files = sorted(lg.generate_list(args.mark_dir, ['json']))
+    json_files = select_samples(json_files, args.mode, args.count,
+                                num_workers=args.workers,
+                                image_dir=args.image_dir)
+    render_sheets(json_files, args.output, args.columns, args.rows,
+                  num_workers=args.workers, image_dir=args.image_dir)
+
+
+if __name__ == '__main__':
+    main()
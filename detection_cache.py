@@ -0,0 +1,130 @@
+"""
+A persistent cache of face detection results, keyed by the image content, the
+detection model and the threshold. Re-running extraction on the same images
+skips the blob preparing and the forward pass of the face detector.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import face_detector as fd
+
+
+class DetectionCache(object):
+    """Cache the results of face_detector.get_facebox in a SQLite file."""
+
+    def __init__(self, cache_file='detection_cache.db', max_entries=1000000,
+                 flush_interval=1000):
+        """
+        Initialize the cache.
+        cache_file: the SQLite database file.
+        max_entries: the least recently used entries are evicted once the
+            cache grows beyond this size.
+        flush_interval: the last used time of hits is buffered and written
+            once this many are pending.
+        """
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS detections ("
+            "key TEXT PRIMARY KEY, result TEXT, last_used REAL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS last_used_index "
+            "ON detections (last_used)")
+        self.connection.commit()
+        self.count = self.connection.execute(
+            "SELECT COUNT(*) FROM detections").fetchone()[0]
+
+        self.model_id = self._get_model_id()
+
+    def _get_model_id(self):
+        """Identify the model by the content of its files, the input size and
+        the decoding. Retrained weights of the same size get a new id."""
+        crumbs = [str(fd.WIDTH), str(fd.HEIGHT), 'v' + str(fd.DECODE_VERSION)]
+        digest = hashlib.blake2b(digest_size=20)
+        for model_file in (fd.PROTOTXT, fd.MODEL):
+            crumbs.append(os.path.basename(model_file))
+            if os.path.exists(model_file):
+                with open(model_file, 'rb') as fid:
+                    for block in iter(lambda: fid.read(1 << 20), b''):
+                        digest.update(block)
+        crumbs.append(digest.hexdigest())
+        return '-'.join(crumbs)
+
+    def get_key(self, image, threshold):
+        """Get the cache key of an image."""
+        digest = hashlib.blake2b(image.tobytes(), digest_size=20)
+        digest.update(str(image.shape).encode())
+        return "{}:{}:{}".format(digest.hexdigest(), self.model_id, threshold)
+
+    def get_facebox(self, image, threshold=0.5):
+        """
+        Same as face_detector.get_facebox, with the result read from the cache
+        if the same image has been detected before.
+        """
+        key = self.get_key(image, threshold)
+        row = self.connection.execute(
+            "SELECT result FROM detections WHERE key = ?", (key,)).fetchone()
+
+        if row is not None:
+            self.hits += 1
+            self.pending[key] = time.time()
+            if len(self.pending) >= self.flush_interval:
+                self.flush()
+            confidences, faceboxes = json.loads(row[0])
+            return confidences, faceboxes
+
+        self.misses += 1
+        confidences, faceboxes = fd.get_facebox(image, threshold)
+        confidences = [float(conf) for conf in confidences]
+        faceboxes = [[int(x) for x in box] for box in faceboxes]
+        self.connection.execute(
+            "INSERT OR REPLACE INTO detections VALUES (?, ?, ?)",
+            (key, json.dumps([confidences, faceboxes]), time.time()))
+        self.count += 1
+        self.evict()
+        self.flush()
+
+        return confidences, faceboxes
+
+    def flush(self):
+        """Write the buffered last used times and commit."""
+        if self.pending:
+            self.connection.executemany(
+                "UPDATE detections SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in self.pending.items()])
+            self.pending = {}
+        self.connection.commit()
+
+    def evict(self):
+        """Remove the least recently used entries beyond max_entries."""
+        if self.count > self.max_entries:
+            self.flush()
+            self.connection.execute(
+                "DELETE FROM detections WHERE key IN (SELECT key FROM "
+                "detections ORDER BY last_used LIMIT ?)",
+                (self.count - self.max_entries,))
+            self.count = self.max_entries
+
+    @property
+    def hit_rate(self):
+        """The ratio of requests served by the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        """Print the hit rate statistics."""
+        print("Detection cache hits: {}, misses: {}, hit rate: {:.1%}".format(
+            self.hits, self.misses, self.hit_rate))
+
+    def close(self):
+        """Write the pending updates and close the database."""
+        self.flush()
+        self.connection.close()
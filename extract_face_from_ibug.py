@@ -10,6 +10,8 @@ import numpy as np
 from tqdm import tqdm
 
 import pts_tools as pt
+from detection_cache import DetectionCache
+from image_index import ImageIndex
 
 # Where the original IBUG data is located.
 DATA_DIR = "/data/dataset/public/facial_landmark/300VW_Dataset_2015_12_14"
@@ -19,18 +21,19 @@ TARGET_DIR = "/data/landmark"
 
 TARGET_SIZE = 112
 
+# Face detection results and the points are cached here for the following
+# runs.
+CACHE_FILE = "/data/landmark/detection_cache.db"
+PTS_CACHE_FILE = "/data/landmark/pts_cache.npy"
+INDEX_FILE = "/data/landmark/image_index.json"
 
-def read_image(point_file):
-    """Read the corresponding image."""
-    head, tail = os.path.split(point_file)
-    image_file = tail.split('.')[-2]
-    img_jpg = os.path.join(head, image_file + ".jpg")
-    img_png = os.path.join(head, image_file + ".png")
-    if os.path.exists(img_jpg):
-        img = cv2.imread(img_jpg)
-    else:
-        img = cv2.imread(img_png)
-    return img
+
+def read_image(point_file, index):
+    """Read the corresponding image, None if there is not any."""
+    image_file = index.get(point_file)
+    if image_file is None:
+        return None
+    return cv2.imread(image_file)
 
 
 def get_valid_points(box, points):
@@ -56,10 +59,10 @@ def get_valid_points(box, points):
     return points
 
 
-def extract_face(image, points):
+def extract_face(image, points, cache=None):
     """Extract face area from image and pts file."""
     # Get a valid face area box.
-    valid_box = pt.get_valid_box(image, points)
+    valid_box = pt.get_valid_box(image, points, cache)
     if valid_box is None:
         print("Oops, can not find valid box, using minimal box.")
         valid_box = pt.get_minimal_box(points)
@@ -84,24 +87,27 @@ def main():
             if file_name.split(".")[-1] in ["pts"]:
                 pts_file_list.append(os.path.join(file_path, file_name))
     print("PTS file numbers: {}".format(len(pts_file_list)))
+    all_points = pt.read_points_bulk(pts_file_list, PTS_CACHE_FILE)
+    index = ImageIndex(DATA_DIR, cache_file=INDEX_FILE)
 
     # Extract the image one by one. Use a dict to keep file count.
     counter = {'invalid': 0}
+    cache = DetectionCache(CACHE_FILE)
 
-    for file_name in tqdm(pts_file_list):
-        # Read points and image, make sure point importing goes well.
-        points = pt.read_points(file_name)
-        assert len(points) == 68, "The landmarks should contain 68 points."
-        image = read_image(file_name)
+    for file_name, points in tqdm(zip(pts_file_list, all_points),
+                                  total=len(pts_file_list)):
+        # Read image, the points are updated in place so make them a list.
+        points = points.tolist()
+        image = read_image(file_name, index)
 
         # Fast check invalid pts file.
-        if pt.points_are_valid(points, image) is False:
+        if image is None or pt.points_are_valid(points, image) is False:
             counter['invalid'] += 1
             print("Invalid pts file, ignored:", file_name)
             continue
 
         # Extract face image and new points.
-        face_image, points_normalized = extract_face(image, points)
+        face_image, points_normalized = extract_face(image, points, cache)
 
         # Mark the result
         # points_restored = []
@@ -137,6 +143,8 @@ def main():
     print("All done! Total file: {}, invalid: {}, succeed: {}".format(
         len(pts_file_list), counter['invalid'],
         len(pts_file_list) - counter['invalid']))
+    cache.report()
+    cache.close()
 
 
 if __name__ == '__main__':
@@ -3,27 +3,71 @@ This script is slightly modified for facial landmark localization.
 You can find the original code here:
 https://github.com/opencv/opencv/blob/master/samples/dnn/resnet_ssd_face_python.py
 """
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2 as cv
+import numpy as np
 from cv2 import dnn
 
 WIDTH = 300
 HEIGHT = 300
 
+# The smallest face the network detects reliably, relative to its input.
+MIN_FACE_RATIO = 0.1
+
+# Bump this whenever decode_detections changes its output, i.e. version 2
+# clips the boxes by the image bounds, so that cached results are refreshed.
+DECODE_VERSION = 2
+
 PROTOTXT = 'assets/deploy.prototxt'
 MODEL = 'assets/res10_300x300_ssd_iter_140000.caffemodel'
 
 CASCADES_FILE = "/opt/opencv/data/lbpcascades/lbpcascade_frontalface_improved.xml"
-CASCADES = cv.CascadeClassifier(CASCADES_FILE)
 
-NET = dnn.readNetFromCaffe(PROTOTXT, MODEL)
+# The models are loaded on first use. Call load_models() to load them from
+# other paths, or to warm them up before the work starts.
+CASCADES = None
+NET = None
+
 VIDEO = '/home/robin/Documents/landmark/dataset/300VW_Dataset_2015_12_14/538/vid.avi'
 
 
-def get_lbp_facebox(image):
+def load_models(prototxt=None, model=None, cascades_file=None):
     """
-    Get the bounding box fo faces in image by LBP feature.
+    Load the SSD network and the LBP cascades. Paths not provided fall back
+    to PROTOTXT, MODEL and CASCADES_FILE.
     """
-    rects = CASCADES.detectMultiScale(image, scaleFactor=1.3, minNeighbors=4, minSize=(30, 30),
+    global NET, CASCADES
+    NET = dnn.readNetFromCaffe(prototxt or PROTOTXT, model or MODEL)
+    CASCADES = cv.CascadeClassifier(cascades_file or CASCADES_FILE)
+
+
+def get_net():
+    """Get the SSD network, load it if not yet."""
+    global NET
+    if NET is None:
+        NET = dnn.readNetFromCaffe(PROTOTXT, MODEL)
+    return NET
+
+
+def get_cascades():
+    """Get the LBP cascades, load it if not yet."""
+    global CASCADES
+    if CASCADES is None:
+        CASCADES = cv.CascadeClassifier(CASCADES_FILE)
+    return CASCADES
+
+
+def get_lbp_facebox(image, cascades=None):
+    """
+    Get the bounding box fo faces in image by LBP feature. The module
+    cascades is used if cascades is not provided.
+    """
+    cascades = cascades or get_cascades()
+    rects = cascades.detectMultiScale(image, scaleFactor=1.3, minNeighbors=4, minSize=(30, 30),
                                       flags=cv.CASCADE_SCALE_IMAGE)
     if len(rects) == 0:
         return []
@@ -33,31 +77,507 @@ def get_lbp_facebox(image):
     return rects
 
 
-def get_facebox(image=None, threshold=0.5):
+def get_facebox(image=None, threshold=0.5, net=None, as_array=False,
+                nms_threshold=None, min_size=0):
     """
-    Get the bounding box of faces in image.
+    Get the bounding box of faces in image. The module network is used if
+    net is not provided.
+    Return (confidences, faceboxes) as lists, or as numpy arrays of shape
+    (N,) and (N, 4) if as_array is True. See decode_detections for the
+    others arguments.
     """
-    rows = image.shape[0]
-    cols = image.shape[1]
+    net = net or get_net()
+    net.setInput(dnn.blobFromImage(
+        image, 1.0, (WIDTH, HEIGHT), (104.0, 177.0, 123.0), False, False))
+    detections = net.forward()
 
-    confidences = []
-    faceboxes = []
+    result = decode_detections(detections, [image.shape], threshold,
+                               nms_threshold, min_size)[0]
+    return result if as_array else to_list(result)
 
-    NET.setInput(dnn.blobFromImage(
-        image, 1.0, (WIDTH, HEIGHT), (104.0, 177.0, 123.0), False, False))
-    detections = NET.forward()
 
-    for result in detections[0, 0, :, :]:
-        confidence = result[2]
-        if confidence > threshold:
-            x_left_bottom = int(result[3] * cols)
-            y_left_bottom = int(result[4] * rows)
-            x_right_top = int(result[5] * cols)
-            y_right_top = int(result[6] * rows)
-            confidences.append(confidence)
-            faceboxes.append(
-                [x_left_bottom, y_left_bottom, x_right_top, y_right_top])
-    return confidences, faceboxes
+def get_faceboxes(images, threshold=0.5, net=None, as_array=False,
+                  nms_threshold=None, min_size=0):
+    """
+    Get the bounding boxes of faces in a batch of images by one forward pass.
+    The images could be of any size.
+    Return a list of (confidences, faceboxes), one for each image.
+    """
+    if len(images) == 0:
+        return []
+
+    net = net or get_net()
+    net.setInput(dnn.blobFromImages(
+        images, 1.0, (WIDTH, HEIGHT), (104.0, 177.0, 123.0), False, False))
+    detections = net.forward()
+
+    results = decode_detections(detections, [image.shape for image in images],
+                                threshold, nms_threshold, min_size)
+    return results if as_array else [to_list(result) for result in results]
+
+
+def decode_detections(detections, image_shapes, threshold=0.5,
+                      nms_threshold=None, min_size=0):
+    """
+    Split the detections of shape [1, 1, K, 7] by the image id column, scale
+    the boxes to the size of each image and clip them by the image bounds.
+    threshold: detections of lower confidence are dropped.
+    nms_threshold: if provided, overlapped boxes of IoU above it are
+        suppressed by the one of higher confidence.
+    min_size: boxes narrower or shorter than this are dropped.
+    Return a list of (confidences, faceboxes) for each image, as numpy arrays
+    of shape (N,) in float32 and (N, 4) in int32.
+    """
+    detections = detections[0, 0]
+    detections = detections[detections[:, 2] > threshold]
+    image_ids = detections[:, 0].astype(np.int32)
+
+    results = []
+    for image_id, shape in enumerate(image_shapes):
+        rows, cols = shape[:2]
+        result = detections[image_ids == image_id]
+        confidences = result[:, 2]
+
+        # Scale, truncate like int() and clip the boxes.
+        boxes = result[:, 3:7] * np.float32([cols, rows, cols, rows])
+        bounds = np.array([cols, rows, cols, rows], np.int32)
+        boxes = np.clip(boxes.astype(np.int32), 0, bounds)
+
+        keep = np.ones(len(boxes), dtype=bool)
+        if min_size > 0:
+            keep &= (boxes[:, 2] - boxes[:, 0] >= min_size) & \
+                (boxes[:, 3] - boxes[:, 1] >= min_size)
+        confidences, boxes = confidences[keep], boxes[keep]
+
+        if nms_threshold is not None:
+            keep = nms(boxes, confidences, nms_threshold)
+            confidences, boxes = confidences[keep], boxes[keep]
+
+        results.append((confidences, boxes))
+
+    return results
+
+
+def get_tiles(rows, cols, tile_size, overlap=0.25):
+    """
+    Split an image of size (rows, cols) into overlapped square tiles.
+    Return a list of tiles [left_x, top_y, right_x, bottom_y].
+    """
+    def _get_starts(length):
+        if length <= tile_size:
+            return [0]
+        stride = max(int(tile_size * (1 - overlap)), 1)
+        count = int(np.ceil((length - tile_size) / stride)) + 1
+        # Spread the tiles evenly so the last one ends at the image edge.
+        return np.linspace(0, length - tile_size, count).astype(int).tolist()
+
+    tiles = []
+    for top_y in _get_starts(rows):
+        for left_x in _get_starts(cols):
+            tiles.append([left_x, top_y,
+                          min(left_x + tile_size, cols),
+                          min(top_y + tile_size, rows)])
+    return tiles
+
+
+def get_facebox_tiled(image, threshold=0.5, min_face_size=24, overlap=0.25,
+                      nms_threshold=0.4, net=None, max_batch=16):
+    """
+    Detect small faces in large images. The image is split into overlapped
+    tiles small enough for faces of min_face_size pixels to be detected.
+    The tiles and the whole image run in batched forward passes of at most
+    max_batch crops, the boxes are mapped back to the image and the
+    duplicates merged by NMS.
+    Return (confidences, faceboxes) as numpy arrays.
+    """
+    rows, cols = image.shape[:2]
+    tile_size = max(int(min_face_size / MIN_FACE_RATIO), WIDTH)
+    tiles = get_tiles(rows, cols, tile_size, overlap)
+    if len(tiles) == 1:
+        return get_facebox(image, threshold, net, as_array=True,
+                           nms_threshold=nms_threshold)
+
+    # The whole image is kept for the faces larger than a tile.
+    tiles.append([0, 0, cols, rows])
+    crops = [image[t[1]:t[3], t[0]:t[2]] for t in tiles]
+    results = []
+    for i in range(0, len(crops), max_batch):
+        results.extend(get_faceboxes(crops[i:i + max_batch], threshold, net,
+                                     as_array=True))
+
+    confidences = np.concatenate([conf for conf, _ in results])
+    boxes = np.concatenate(
+        [boxes + np.int32([t[0], t[1], t[0], t[1]])
+         for t, (_, boxes) in zip(tiles, results)])
+    keep = nms(boxes, confidences, nms_threshold)
+
+    return confidences[keep], boxes[keep]
+
+
+def nms(boxes, confidences, iou_threshold=0.5):
+    """
+    Non-maximum suppression of boxes.
+    boxes: numpy array of shape (N, 4).
+    confidences: numpy array of shape (N,).
+    Return the indices of the boxes kept, in descending order of confidence.
+    """
+    boxes = boxes.astype(np.float32)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-confidences, kind='stable')
+
+    keep = []
+    while len(order) > 0:
+        best = order[0]
+        keep.append(best)
+        others = order[1:]
+
+        # IoU between the best box and all the others at once.
+        width = np.minimum(boxes[best, 2], boxes[others, 2]) - \
+            np.maximum(boxes[best, 0], boxes[others, 0])
+        height = np.minimum(boxes[best, 3], boxes[others, 3]) - \
+            np.maximum(boxes[best, 1], boxes[others, 1])
+        intersection = np.maximum(width, 0) * np.maximum(height, 0)
+        union = areas[best] + areas[others] - intersection
+        iou = intersection / np.maximum(union, 1e-6)
+
+        order = others[iou <= iou_threshold]
+
+    return np.array(keep, dtype=np.int64)
+
+
+def to_list(result):
+    """Convert the (confidences, faceboxes) arrays into lists."""
+    confidences, faceboxes = result
+    return list(confidences), faceboxes.tolist()
+
+
+class DetectorPool(object):
+    """
+    Detect faces from multiple threads. Every worker thread holds its own
+    network, as setInput and forward mutate the network state. OpenCV
+    releases the GIL during forward, so the workers run concurrently.
+    """
+
+    def __init__(self, num_workers=4, opencv_threads=None, prototxt=None,
+                 model=None):
+        """
+        Initialize the pool.
+        num_workers: number of worker threads.
+        opencv_threads: threads OpenCV may use inside each call. This is a
+            process wide setting, by default the CPU cores are shared by the
+            workers so that they do not oversubscribe the cores.
+        prototxt, model: the network files, default to PROTOTXT and MODEL.
+        """
+        if opencv_threads is None:
+            opencv_threads = max(1, cv.getNumberOfCPUs() // num_workers)
+        cv.setNumThreads(opencv_threads)
+
+        self.prototxt = prototxt or PROTOTXT
+        self.model = model or MODEL
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(num_workers)
+
+    def _get_net(self):
+        """Get the network of the current thread."""
+        net = getattr(self._local, 'net', None)
+        if net is None:
+            net = dnn.readNetFromCaffe(self.prototxt, self.model)
+            self._local.net = net
+        return net
+
+    def detect(self, image, threshold=0.5):
+        """Detect faces in one image in the calling thread."""
+        return get_facebox(image, threshold, net=self._get_net())
+
+    def detect_many(self, images, threshold=0.5):
+        """
+        Detect faces in images concurrently.
+        Return a list of (confidences, faceboxes) in the order of images.
+        """
+        return list(self._executor.map(
+            lambda image: self.detect(image, threshold), images))
+
+    def close(self):
+        """Shut down the worker threads."""
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FaceTracker(object):
+    """
+    Detect faces on key frames only and track the boxes by optical flow in
+    between. A new detection runs every detect_interval frames, or as soon as
+    any box could not be tracked reliably.
+    """
+
+    def __init__(self, detect_interval=10, min_track_ratio=0.6, threshold=0.5,
+                 grid_size=5):
+        """
+        Initialize the tracker.
+        detect_interval: run the detector at least once every these frames.
+        min_track_ratio: re-detect if the ratio of points tracked in any box
+            falls below this value.
+        threshold: the detection threshold.
+        grid_size: points tracked in each box, grid_size x grid_size.
+        """
+        self.detect_interval = detect_interval
+        self.min_track_ratio = min_track_ratio
+        self.threshold = threshold
+        self.grid_size = grid_size
+
+        self.last_gray = None
+        self.confidences = []
+        self.faceboxes = []
+        self.frames_since_detection = 0
+
+        # Statistics.
+        self.frame_count = 0
+        self.detector_calls = 0
+
+    def _detect(self, frame):
+        """Run the detector on a key frame."""
+        self.confidences, self.faceboxes = get_facebox(frame, self.threshold)
+        self.frames_since_detection = 0
+        self.detector_calls += 1
+
+    def _track_box(self, gray, box):
+        """
+        Track one box from the last frame into the current one.
+        Return the new box in float numbers, or None if the box is lost.
+        """
+        # Points on a grid in the central area of the box, away from the
+        # background around the face.
+        margin_x = (box[2] - box[0]) / 4
+        margin_y = (box[3] - box[1]) / 4
+        x_steps = np.linspace(box[0] + margin_x, box[2] - margin_x, self.grid_size)
+        y_steps = np.linspace(box[1] + margin_y, box[3] - margin_y, self.grid_size)
+        points = np.float32(np.dstack(np.meshgrid(x_steps, y_steps)))
+        points = points.reshape(-1, 1, 2)
+
+        # Track forward and backward, keep the consistent points.
+        forward, status_f, _ = cv.calcOpticalFlowPyrLK(
+            self.last_gray, gray, points, None)
+        backward, status_b, _ = cv.calcOpticalFlowPyrLK(
+            gray, self.last_gray, forward, None)
+        error = np.linalg.norm(points - backward, axis=2).flatten()
+        good = (status_f.flatten() == 1) & (status_b.flatten() == 1) & (error < 1.0)
+        if good.mean() < self.min_track_ratio:
+            return None
+
+        # Box moves by the median shift and scales by the median spread.
+        old_points = points[good].reshape(-1, 2)
+        new_points = forward[good].reshape(-1, 2)
+        shift = np.median(new_points - old_points, axis=0)
+        old_spread = np.linalg.norm(old_points - old_points.mean(axis=0), axis=1)
+        new_spread = np.linalg.norm(new_points - new_points.mean(axis=0), axis=1)
+        scale = np.median(new_spread[old_spread > 0] / old_spread[old_spread > 0])
+
+        center_x = (box[0] + box[2]) / 2 + shift[0]
+        center_y = (box[1] + box[3]) / 2 + shift[1]
+        half_w = (box[2] - box[0]) * scale / 2
+        half_h = (box[3] - box[1]) * scale / 2
+        return [center_x - half_w, center_y - half_h,
+                center_x + half_w, center_y + half_h]
+
+    def update(self, frame):
+        """
+        Get the face boxes of a new frame.
+        Return (confidences, faceboxes), the same as get_facebox.
+        """
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        self.frame_count += 1
+
+        if self.last_gray is None or self.frames_since_detection + 1 >= self.detect_interval:
+            self._detect(frame)
+        else:
+            tracked = [self._track_box(gray, box) for box in self.faceboxes]
+            if any(box is None for box in tracked):
+                self._detect(frame)
+            else:
+                self.faceboxes = tracked
+                self.frames_since_detection += 1
+
+        self.last_gray = gray
+
+        # Clip the boxes by the frame like get_facebox does. The float boxes
+        # are kept as they are to be tracked further.
+        rows, cols = gray.shape
+        bounds = [cols, rows, cols, rows]
+        faceboxes = [[min(max(int(x), 0), bound) for x, bound in zip(box, bounds)]
+                     for box in self.faceboxes]
+        return self.confidences, faceboxes
+
+
+class GatedDetector(object):
+    """
+    Run the fast LBP cascade on a downscaled frame first, and the SSD only
+    where the cascade fires. Every full_check_interval frames the SSD runs on
+    the whole frame regardless, to catch the faces the cascade misses.
+    """
+
+    def __init__(self, scale=0.5, full_check_interval=30, mode='region',
+                 region_expand=0.5, threshold=0.5):
+        """
+        Initialize the detector.
+        scale: the cascade runs on the frame resized by this factor.
+        full_check_interval: run the SSD on the whole frame at least once
+            every these frames. 0 disables the periodic check.
+        mode: 'frame' runs the SSD on the whole frame once the cascade fires,
+            'region' runs it only on the regions around the cascade boxes.
+        region_expand: the cascade boxes are expanded by this ratio on each
+            side to make the regions.
+        threshold: the detection threshold of the SSD.
+        """
+        assert mode in ('frame', 'region'), "Mode should be frame or region."
+        self.scale = scale
+        self.full_check_interval = full_check_interval
+        self.mode = mode
+        self.region_expand = region_expand
+        self.threshold = threshold
+
+        # Statistics.
+        self.frame_count = 0
+        self.ssd_frames = 0
+
+    def _get_regions(self, lbp_boxes, rows, cols):
+        """Expand the cascade boxes into the regions for the SSD."""
+        regions = []
+        for box in lbp_boxes:
+            box = [int(x / self.scale) for x in box]
+            delta_x = int((box[2] - box[0]) * self.region_expand)
+            delta_y = int((box[3] - box[1]) * self.region_expand)
+            regions.append([max(box[0] - delta_x, 0), max(box[1] - delta_y, 0),
+                            min(box[2] + delta_x, cols),
+                            min(box[3] + delta_y, rows)])
+        return regions
+
+    def update(self, frame):
+        """
+        Detect faces in a new frame.
+        Return (confidences, faceboxes), the same as get_facebox.
+        """
+        self.frame_count += 1
+        full_check = self.full_check_interval > 0 and \
+            (self.frame_count - 1) % self.full_check_interval == 0
+        if full_check:
+            self.ssd_frames += 1
+            return get_facebox(frame, self.threshold)
+
+        small = cv.resize(frame, None, fx=self.scale, fy=self.scale)
+        small = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        lbp_boxes = get_lbp_facebox(small)
+        if len(lbp_boxes) == 0:
+            return [], []
+
+        self.ssd_frames += 1
+        if self.mode == 'frame':
+            return get_facebox(frame, self.threshold)
+
+        rows, cols = frame.shape[:2]
+        regions = self._get_regions(lbp_boxes, rows, cols)
+        crops = [frame[r[1]:r[3], r[0]:r[2]] for r in regions]
+        results = get_faceboxes(crops, self.threshold, as_array=True)
+        confidences = np.concatenate([conf for conf, _ in results])
+        boxes = np.concatenate(
+            [boxes + np.int32([r[0], r[1], r[0], r[1]])
+             for r, (_, boxes) in zip(regions, results)])
+        keep = nms(boxes, confidences, 0.4)
+
+        return to_list((confidences[keep], boxes[keep]))
+
+
+def get_recall(faceboxes, labels, iou_threshold=0.5):
+    """Count the labeled boxes matched by any of the faceboxes."""
+    return sum(1 for label in labels
+               if any(get_iou(label, box) >= iou_threshold for box in faceboxes))
+
+
+def evaluate_gating(samples, iou_threshold=0.5, **policy):
+    """
+    Compare the gated detection with the full SSD on labeled samples.
+    samples: a list of (image, labeled face boxes).
+    policy: the arguments of GatedDetector.
+    Print and return the recall of both, and the ratio of SSD runs saved.
+    """
+    gated = GatedDetector(**policy)
+    label_count = 0
+    full_hits = 0
+    gated_hits = 0
+    for image, labels in samples:
+        label_count += len(labels)
+        _, full_boxes = get_facebox(image, gated.threshold)
+        _, gated_boxes = gated.update(image)
+        full_hits += get_recall(full_boxes, labels, iou_threshold)
+        gated_hits += get_recall(gated_boxes, labels, iou_threshold)
+
+    full_recall = full_hits / max(label_count, 1)
+    gated_recall = gated_hits / max(label_count, 1)
+    print("Recall, full SSD: {:.3f}, gated: {:.3f}, lost: {:.3f}".format(
+        full_recall, gated_recall, full_recall - gated_recall))
+    print("SSD runs: {}/{} frames".format(gated.ssd_frames, gated.frame_count))
+    return full_recall, gated_recall
+
+
+def get_iou(box_a, box_b):
+    """Get the intersection over union of two boxes."""
+    width = min(box_a[2], box_b[2]) - max(box_a[0], box_b[0])
+    height = min(box_a[3], box_b[3]) - max(box_a[1], box_b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    return intersection / float(area_a + area_b - intersection)
+
+
+def evaluate_tracker(video, detect_interval=10, min_iou=0.7, max_frames=300):
+    """
+    Compare the tracker with detection on every frame.
+    Every detected box is matched to the tracked box of the best IoU. Print
+    the detector calls saved and whether the mean IoU is within min_iou.
+    """
+    cap = cv.VideoCapture(video)
+    tracker = FaceTracker(detect_interval)
+    ious = []
+    for _ in range(max_frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        _, detected = get_facebox(frame)
+        _, tracked = tracker.update(frame)
+        for box in detected:
+            ious.append(max([get_iou(box, t) for t in tracked] or [0.0]))
+
+    mean_iou = np.mean(ious) if ious else 1.0
+    print("Frames: {}, detector calls: {}, {:.1f}x fewer.".format(
+        tracker.frame_count, tracker.detector_calls,
+        tracker.frame_count / max(tracker.detector_calls, 1)))
+    print("Mean IoU: {:.3f}, {} the tolerance {:.2f}.".format(
+        mean_iou, "within" if mean_iou >= min_iou else "out of", min_iou))
+    return mean_iou
+
+
+def benchmark_batch(batch_sizes=(1, 2, 4, 8, 16, 32, 64), image_num=64):
+    """Compare the throughput of different batch sizes on random images."""
+    images = []
+    for i in range(image_num):
+        size = (240 + 40 * (i % 4), 320 + 80 * (i % 3), 3)
+        images.append(np.random.randint(0, 256, size, dtype=np.uint8))
+
+    # Warm up.
+    get_facebox(images[0])
+
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for i in range(0, image_num, batch_size):
+            get_faceboxes(images[i:i + batch_size])
+        speed = image_num / (time.perf_counter() - start)
+        print("Batch size {}: {:.1f} images/sec".format(batch_size, speed))
 
 
 def draw_result(image, confidences, faceboxes):
@@ -89,10 +609,33 @@ def draw_box(image, faceboxes, box_color=(255, 255, 255), line_width=4):
 
 def main():
     """The main entrance"""
-    cap = cv.VideoCapture(VIDEO)
+    parser = ArgumentParser()
+    parser.add_argument('--video', type=str, default=VIDEO,
+                        help='the video file to be detected')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='benchmark batched detection on random images')
+    parser.add_argument('--track', type=int, default=0,
+                        help='detect every N frames and track in between')
+    parser.add_argument('--evaluate', action='store_true',
+                        help='compare tracking with per frame detection')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_batch()
+        return
+
+    if args.evaluate:
+        evaluate_tracker(args.video, args.track or 10)
+        return
+
+    tracker = FaceTracker(args.track) if args.track else None
+    cap = cv.VideoCapture(args.video)
     while True:
         ret, frame = cap.read()
-        confidences, faceboxes = get_facebox(frame, threshold=0.5)
+        if tracker is None:
+            confidences, faceboxes = get_facebox(frame, threshold=0.5)
+        else:
+            confidences, faceboxes = tracker.update(frame)
         draw_result(frame, confidences, faceboxes)
         lbp_box = get_lbp_facebox(frame)
         draw_box(frame, lbp_box)
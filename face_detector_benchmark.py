@@ -0,0 +1,155 @@
+"""
+This script benchmarks the face detectors on synthetic images, so no dataset
+is required. Cold start, warm latency and throughput under different OpenCV
+thread numbers are measured, and the results are written in JSON to be
+compared across commits.
+"""
+import json
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+import cv2 as cv
+import numpy as np
+
+import face_detector as fd
+
+RESOLUTIONS = [(240, 320), (480, 640), (720, 1280), (1080, 1920)]
+
+
+def make_images(rows, cols, count=8, seed=0):
+    """Generate images of smoothed noise with some face sized blobs."""
+    rng = np.random.RandomState(seed)
+    images = []
+    for _ in range(count):
+        image = rng.randint(0, 256, (rows, cols, 3)).astype(np.uint8)
+        image = cv.GaussianBlur(image, (9, 9), 0)
+        for _ in range(3):
+            radius = rng.randint(min(rows, cols) // 16, min(rows, cols) // 6)
+            center = (rng.randint(radius, cols - radius),
+                      rng.randint(radius, rows - radius))
+            color = tuple(int(c) for c in rng.randint(60, 200, 3))
+            cv.ellipse(image, center, (radius, int(radius * 1.3)), 0, 0, 360,
+                       color, -1)
+        images.append(image)
+    return images
+
+
+def get_cold_start():
+    """Time importing the module, loading the models and the first detection
+    in a fresh process."""
+    code = ("import time; start = time.perf_counter(); "
+            "import numpy as np; import face_detector as fd; "
+            "imported = time.perf_counter(); fd.load_models(); "
+            "loaded = time.perf_counter(); "
+            "fd.get_facebox(np.zeros((480, 640, 3), np.uint8)); "
+            "done = time.perf_counter(); "
+            "print(imported - start, loaded - imported, done - loaded)")
+    output = subprocess.check_output([sys.executable, '-c', code])
+    import_time, load_time, first_call = [
+        float(x) for x in output.split()]
+    return {'import_ms': import_time * 1000,
+            'load_models_ms': load_time * 1000,
+            'first_call_ms': first_call * 1000}
+
+
+def get_latency(function, inputs, repeat=20):
+    """Call function on the inputs in turn and get the latency percentiles."""
+    function(inputs[0])
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(inputs[i % len(inputs)])
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'p50_ms': float(np.percentile(timings, 50)),
+            'p95_ms': float(np.percentile(timings, 95)),
+            'p99_ms': float(np.percentile(timings, 99))}
+
+
+def get_throughput(function, images, batch_size=1, repeat=2):
+    """Get the images processed per second."""
+    batches = [images[i:i + batch_size]
+               for i in range(0, len(images), batch_size)]
+    function(batches[0])
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            function(batch)
+    return repeat * len(images) / (time.perf_counter() - start)
+
+
+def run_benchmark(resolutions=RESOLUTIONS, thread_numbers=(1, 2, 4),
+                  repeat=20, image_count=8):
+    """Run all the benchmarks and return the results in a dict."""
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': get_commit(),
+        'opencv': cv.__version__,
+        'python': platform.python_version(),
+        'cpus': cv.getNumberOfCPUs(),
+        'cold_start': get_cold_start(),
+        'latency': {},
+        'throughput': {}}
+
+    fd.load_models()
+    for rows, cols in resolutions:
+        images = make_images(rows, cols, image_count)
+        gray = [cv.cvtColor(image, cv.COLOR_BGR2GRAY) for image in images]
+        name = "{}x{}".format(cols, rows)
+        print("Benchmarking {}".format(name))
+
+        cv.setNumThreads(cv.getNumberOfCPUs())
+        results['latency'][name] = {
+            'get_facebox': get_latency(fd.get_facebox, images, repeat),
+            'get_lbp_facebox': get_latency(fd.get_lbp_facebox, gray, repeat),
+            'get_facebox_tiled': get_latency(fd.get_facebox_tiled, images,
+                                             max(repeat // 4, 1))}
+
+        throughput = {}
+        for threads in thread_numbers:
+            cv.setNumThreads(threads)
+            throughput[str(threads)] = {
+                'get_facebox': get_throughput(
+                    lambda batch: fd.get_facebox(batch[0]), images),
+                'get_faceboxes_batch_8': get_throughput(
+                    fd.get_faceboxes, images, batch_size=8)}
+        with fd.DetectorPool(num_workers=4) as pool:
+            throughput['pool_4_workers'] = {
+                'detect_many': get_throughput(pool.detect_many, images,
+                                              batch_size=len(images))}
+        results['throughput'][name] = throughput
+
+    return results
+
+
+def get_commit():
+    """Get the current git commit, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """The main entrance"""
+    parser = ArgumentParser()
+    parser.add_argument('--output', type=str, default='face_benchmark.json',
+                        help='where the JSON results go')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4],
+                        help='OpenCV thread numbers to test')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs for each latency measurement')
+    args = parser.parse_args()
+
+    results = run_benchmark(thread_numbers=args.threads, repeat=args.repeat)
+    with open(args.output, 'w') as fid:
+        json.dump(results, fid, indent=2)
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
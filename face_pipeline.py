@@ -0,0 +1,239 @@
+"""
+This script runs face detection on a video in a pipeline. Frames are read by
+a capture thread, detected by one or more inference workers and written by
+the output stage, with bounded queues in between, so that decoding, inference
+and writing overlap with each other.
+"""
+import json
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+
+import cv2 as cv
+from cv2 import dnn
+
+import face_detector as fd
+
+
+class VideoPipeline(object):
+    """Detect faces in a video with pipelined stages."""
+
+    def __init__(self, num_workers=2, queue_size=8, threshold=0.5,
+                 with_lbp=True):
+        """
+        Initialize the pipeline.
+        num_workers: number of inference workers, each holds its own network.
+        queue_size: the capacity of the queues between stages.
+        threshold: the detection threshold.
+        with_lbp: also run the LBP cascade on every frame.
+        """
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.threshold = threshold
+        self.with_lbp = with_lbp
+
+        # Time spent on every frame by each stage.
+        self.timings = {'capture': [], 'inference': [], 'output': []}
+        self.frame_count = 0
+        self.fps = 0.0
+        self.source_fps = 25
+
+        # Exceptions raised in the stages, re-raised by run().
+        self.errors = []
+
+    @staticmethod
+    def _put(item_queue, item, stop):
+        """Put an item into a queue unless the pipeline is stopped.
+        Return False if stopped."""
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(item_queue, stop):
+        """Get an item from a queue, or None if the pipeline is stopped."""
+        while not stop.is_set():
+            try:
+                return item_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _fail(self, error, stop):
+        """Record the exception of a stage and stop the pipeline."""
+        self.errors.append(error)
+        stop.set()
+
+    def _capture(self, video, frame_queue, slots, stop):
+        """Read frames into the frame queue until the video ends or the
+        pipeline is stopped. A slot is taken for every frame and given back
+        by the output stage, so that only so many frames are in flight."""
+        cap = cv.VideoCapture(video)
+        self.source_fps = cap.get(cv.CAP_PROP_FPS) or 25
+        try:
+            index = 0
+            while True:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                start = time.perf_counter()
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                self.timings['capture'].append(time.perf_counter() - start)
+                if not self._put(frame_queue, (index, frame), stop):
+                    break
+                index += 1
+        except Exception as error:
+            self._fail(error, stop)
+        finally:
+            cap.release()
+            for _ in range(self.num_workers):
+                self._put(frame_queue, None, stop)
+
+    def _infer(self, frame_queue, result_queue, stop):
+        """Detect faces in the frames from the frame queue."""
+        try:
+            net = dnn.readNetFromCaffe(fd.PROTOTXT, fd.MODEL)
+            cascades = None
+            if self.with_lbp:
+                cascades = cv.CascadeClassifier(fd.CASCADES_FILE)
+            while True:
+                item = self._get(frame_queue, stop)
+                if item is None:
+                    break
+                index, frame = item
+                start = time.perf_counter()
+                confidences, faceboxes = fd.get_facebox(
+                    frame, self.threshold, net=net)
+                lbp_boxes = []
+                if cascades is not None:
+                    lbp_boxes = fd.get_lbp_facebox(frame, cascades)
+                self.timings['inference'].append(time.perf_counter() - start)
+                if not self._put(result_queue, (index, frame, confidences,
+                                                faceboxes, lbp_boxes), stop):
+                    break
+        except Exception as error:
+            # The frame is lost and the ordered output could not go on.
+            self._fail(error, stop)
+        finally:
+            self._put(result_queue, None, stop)
+
+    def run(self, video, output_file):
+        """
+        Run the pipeline on a video.
+        video: the video file url or a camera index.
+        output_file: an annotated video, or a .json file of the boxes of
+            every frame.
+        """
+        frame_queue = queue.Queue(self.queue_size)
+        result_queue = queue.Queue(self.queue_size)
+
+        # Frames waiting to be written in order are bounded by the slots.
+        slots = threading.Semaphore(2 * self.queue_size + self.num_workers)
+
+        # Set once the output stage is done or any stage failed, so that no
+        # stage waits forever on a full or empty queue.
+        stop = threading.Event()
+        self.errors = []
+
+        threads = [threading.Thread(target=self._capture,
+                                    args=(video, frame_queue, slots, stop))]
+        for _ in range(self.num_workers):
+            threads.append(threading.Thread(
+                target=self._infer, args=(frame_queue, result_queue, stop)))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        # The output stage, frames are written in order.
+        writer = None
+        records = []
+        pending = {}
+        next_index = 0
+        finished = 0
+        try:
+            while finished < self.num_workers:
+                item = self._get(result_queue, stop)
+                if item is None:
+                    if stop.is_set():
+                        break
+                    finished += 1
+                    continue
+                pending[item[0]] = item
+                while next_index in pending:
+                    _, frame, confidences, faceboxes, lbp_boxes = pending.pop(
+                        next_index)
+                    output_start = time.perf_counter()
+                    if output_file.endswith('.json'):
+                        records.append({
+                            'frame': next_index,
+                            'confidences': [float(c) for c in confidences],
+                            'faceboxes': [[int(x) for x in box] for box in faceboxes],
+                            'lbp_boxes': [[int(x) for x in box] for box in lbp_boxes]})
+                    else:
+                        if writer is None:
+                            rows, cols = frame.shape[:2]
+                            writer = cv.VideoWriter(
+                                output_file, cv.VideoWriter_fourcc(*'mp4v'),
+                                self.source_fps,
+                                (cols, rows))
+                        fd.draw_result(frame, confidences, faceboxes)
+                        fd.draw_box(frame, lbp_boxes)
+                        writer.write(frame)
+                    self.timings['output'].append(
+                        time.perf_counter() - output_start)
+                    next_index += 1
+                    slots.release()
+        finally:
+            stop.set()
+
+        for thread in threads:
+            thread.join()
+        if writer is not None:
+            writer.release()
+        if self.errors:
+            raise self.errors[0]
+        if output_file.endswith('.json'):
+            with open(output_file, 'w') as fid:
+                json.dump(records, fid)
+
+        self.frame_count = next_index
+        self.fps = next_index / (time.perf_counter() - start)
+
+    def report(self):
+        """Print the latency of each stage and the end to end FPS."""
+        for stage, timing in self.timings.items():
+            if timing:
+                print("{}: {:.2f} ms/frame".format(
+                    stage, 1000 * sum(timing) / len(timing)))
+        print("Frames: {}, end to end: {:.1f} FPS".format(
+            self.frame_count, self.fps))
+
+
+def main():
+    """The main entrance"""
+    parser = ArgumentParser()
+    parser.add_argument('--video', type=str, default=fd.VIDEO,
+                        help='the video file to be detected')
+    parser.add_argument('--output', type=str, default='detections.mp4',
+                        help='an annotated video or a .json file')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of inference workers')
+    parser.add_argument('--queue_size', type=int, default=8,
+                        help='capacity of the queues between stages')
+    args = parser.parse_args()
+
+    pipeline = VideoPipeline(args.workers, args.queue_size)
+    pipeline.run(args.video, args.output)
+    pipeline.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+An index pairing the annotation files with their images, built in one scan of
+the image directories. Looking up the image of a sample is a dict access, so
+no stat call is made per sample which is slow on network storage.
+
+The index could be cached in a JSON file with the modification times of the
+directories scanned. It is rebuilt once any of them changed.
+"""
+import json
+import os
+from argparse import ArgumentParser
+
+# Image formats in the order of preference.
+IMAGE_FORMATS = ('jpg', 'png')
+
+
+class ImageIndex(object):
+    """Map the annotation file stems to the image files."""
+
+    def __init__(self, image_dir, formats=IMAGE_FORMATS, cache_file=None):
+        """
+        Initialize the index.
+        image_dir: the directory in which the images are, searched recursively.
+        formats: the image file extensions, the former ones are preferred if
+            images of the same name exist in different formats.
+        cache_file: a JSON file to save the index for the following runs.
+        """
+        self.image_dir = os.path.normpath(image_dir)
+        self.formats = list(formats)
+        self.cache_file = cache_file
+
+        # Image path without extension -> extension, and directory -> mtime.
+        self.images = {}
+        self.dirs = {}
+
+        if not self.load():
+            self.build()
+            self.save()
+
+    def build(self):
+        """Scan the image directories once."""
+        self.images = {}
+        self.dirs = {}
+        rank = {fmt: i for i, fmt in enumerate(self.formats)}
+        for file_path, _, file_names in os.walk(self.image_dir):
+            self.dirs[file_path] = os.stat(file_path).st_mtime_ns
+            for file_name in file_names:
+                stem, _, ext = file_name.rpartition('.')
+                if ext not in rank:
+                    continue
+                key = os.path.join(file_path, stem)
+                if key not in self.images or \
+                        rank[ext] < rank[self.images[key]]:
+                    self.images[key] = ext
+
+    def load(self):
+        """Load the index from the cache file if it is up to date."""
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return False
+        with open(self.cache_file) as fid:
+            cache = json.load(fid)
+        if cache['image_dir'] != self.image_dir or \
+                cache['formats'] != self.formats:
+            return False
+
+        # Adding or removing files changes the mtime of their directory.
+        for dir_path, mtime in cache['dirs'].items():
+            try:
+                if os.stat(dir_path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+
+        self.images = cache['images']
+        self.dirs = cache['dirs']
+        return True
+
+    def save(self):
+        """Save the index into the cache file."""
+        if self.cache_file is None:
+            return
+        with open(self.cache_file, 'w') as fid:
+            json.dump({'image_dir': self.image_dir,
+                       'formats': self.formats,
+                       'dirs': self.dirs,
+                       'images': self.images}, fid)
+
+    def get(self, annotation_file, image_dir=None):
+        """
+        Get the image of an annotation file, or None if there is not any.
+        image_dir: where the image is, the same directory of the annotation
+            file by default.
+        """
+        head, tail = os.path.split(annotation_file)
+        if image_dir is not None:
+            head = image_dir
+        key = os.path.join(os.path.normpath(head), tail.split('.')[-2])
+        ext = self.images.get(key)
+        return None if ext is None else key + '.' + ext
+
+    def __len__(self):
+        return len(self.images)
+
+
+def main():
+    """The main entrance"""
+    parser = ArgumentParser()
+    parser.add_argument('image_dir', type=str, help='where the images are')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='the JSON file to save the index')
+    args = parser.parse_args()
+
+    index = ImageIndex(args.image_dir, cache_file=args.cache)
+    print("Images indexed: {}".format(len(index)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+This script shows how to read the quantized DCT coefficients of the luminance
+channel from a baseline JPEG file, without decoding the image into pixels.
+
+Only Huffman coded sequential JPEG files are supported. For any other files
+(progressive, arithmetic coded, 12 bit, not a JPEG at all, or not readable)
+None is returned and the caller should decode the pixels instead.
+
+The entropy decoding is done in pure Python and is much slower than
+cv2.imread, about 14 times on a 1080p image. Use it where the coefficients
+themselves are wanted, not as a speed up.
+"""
+import re
+from argparse import ArgumentParser
+
+import numpy as np
+
+# The natural (row major) index of each coefficient in zigzag order.
+ZIGZAG = np.array([
+    0, 1, 8, 16, 9, 2, 3, 10,
+    17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34,
+    27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36,
+    29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46,
+    53, 60, 61, 54, 47, 55, 62, 63])
+
+# Sequential Huffman coded frames: baseline and extended.
+SOF_SUPPORTED = (0xC0, 0xC1)
+
+# All the other start of frame markers. DHT(C4), JPG(C8) and DAC(CC) excluded.
+SOF_UNSUPPORTED = (0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                   0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+
+# The DC level shift of 8 bit samples, 128 * 8.
+DC_SHIFT = 1024
+
+# Any marker other than stuffed bytes and restart markers ends a scan.
+_SCAN_END = re.compile(b'\xff[^\x00\xd0-\xd7]')
+_RESTART = re.compile(b'\xff[\xd0-\xd7]')
+
+
+def build_huffman_table(counts, symbols):
+    """Build a lookup table indexed by the next 16 bits of the stream.
+    Args:
+        counts: number of codes of each length from 1 to 16.
+        symbols: the symbols in the order of their codes.
+    Returns:
+        a list of 65536 items, each one is (code length << 8 | symbol).
+    """
+    table = [0] * 65536
+    code = 0
+    index = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            shift = 16 - length
+            value = length << 8 | symbols[index]
+            start = code << shift
+            table[start:start + (1 << shift)] = [value] * (1 << shift)
+            code += 1
+            index += 1
+        code <<= 1
+    return table
+
+
+def _decode_segment(data, blocks, mcu_count, dc_tables, ac_tables, store, sink):
+    """Decode the MCUs of one entropy coded segment.
+    Args:
+        data: the entropy coded bytes with stuffing removed.
+        blocks: number of blocks of each component in one MCU.
+        mcu_count: number of MCUs in this segment.
+        dc_tables: the DC Huffman table of each component.
+        ac_tables: the AC Huffman table of each component.
+        store: whether the blocks of each component should be kept.
+        sink: a list the kept blocks are appended to, each as 64 coefficients
+            in zigzag order.
+    """
+    # Pad the data so that peeking 16 bits never runs out of bytes.
+    data = data + b'\x00\x00\x00'
+    pos = 0
+    acc = 0
+    nbits = 0
+    predictors = [0] * len(blocks)
+
+    for _ in range(mcu_count):
+        for comp, block_num in enumerate(blocks):
+            dc_table = dc_tables[comp]
+            ac_table = ac_tables[comp]
+            keep = store[comp]
+            for _ in range(block_num):
+                coefs = [0] * 64 if keep else None
+
+                # The DC coefficient, coded as the difference from the last one.
+                while nbits < 16:
+                    acc = (acc << 8) | data[pos]
+                    pos += 1
+                    nbits += 8
+                entry = dc_table[(acc >> (nbits - 16)) & 0xFFFF]
+                nbits -= entry >> 8
+                size = entry & 0xFF
+                diff = 0
+                if size:
+                    while nbits < size:
+                        acc = (acc << 8) | data[pos]
+                        pos += 1
+                        nbits += 8
+                    diff = (acc >> (nbits - size)) & ((1 << size) - 1)
+                    nbits -= size
+                    if diff < (1 << (size - 1)):
+                        diff -= (1 << size) - 1
+                acc &= (1 << nbits) - 1
+                predictors[comp] += diff
+                if keep:
+                    coefs[0] = predictors[comp]
+
+                # The AC coefficients, coded as (zero run, size) pairs.
+                k = 1
+                while k < 64:
+                    while nbits < 16:
+                        acc = (acc << 8) | data[pos]
+                        pos += 1
+                        nbits += 8
+                    entry = ac_table[(acc >> (nbits - 16)) & 0xFFFF]
+                    nbits -= entry >> 8
+                    run = (entry >> 4) & 0x0F
+                    size = entry & 0x0F
+                    if size == 0:
+                        if run != 15:   # End of block.
+                            break
+                        k += 16
+                        continue
+                    k += run
+                    while nbits < size:
+                        acc = (acc << 8) | data[pos]
+                        pos += 1
+                        nbits += 8
+                    value = (acc >> (nbits - size)) & ((1 << size) - 1)
+                    nbits -= size
+                    acc &= (1 << nbits) - 1
+                    if value < (1 << (size - 1)):
+                        value -= (1 << size) - 1
+                    if keep and k < 64:
+                        coefs[k] = value
+                    k += 1
+
+                if keep:
+                    sink.append(coefs)
+
+
+def read_luma_coefficients(file_name):
+    """Read the DCT coefficients of the luminance channel from a JPEG file.
+
+    The coefficients are dequantized and the DC level shift is undone, so they
+    are in the same scale as cv2.dct of the 8x8 pixel blocks.
+
+    Args:
+        file_name: the JPEG file to be read.
+    Returns:
+        a numpy array of shape [block rows, block columns, 8, 8], or None if
+        the file is not a supported JPEG file or could not be read.
+    """
+    try:
+        with open(file_name, 'rb') as fid:
+            raw = fid.read()
+    except OSError:
+        return None
+    if raw[:2] != b'\xff\xd8':
+        return None
+
+    quant_tables = {}
+    huffman_tables = {}
+    frame = None
+    restart_interval = 0
+    pos = 2
+
+    while pos + 4 <= len(raw):
+        if raw[pos] != 0xFF:
+            return None
+        marker = raw[pos + 1]
+        if marker == 0xFF:          # Fill byte.
+            pos += 1
+            continue
+        if marker == 0xD9:          # End of image.
+            break
+        length = (raw[pos + 2] << 8) | raw[pos + 3]
+        segment = raw[pos + 4:pos + 2 + length]
+        pos += 2 + length
+
+        if marker == 0xDB:          # Quantization tables.
+            i = 0
+            while i < len(segment):
+                precision, table_id = segment[i] >> 4, segment[i] & 0x0F
+                if precision:
+                    values = np.frombuffer(segment[i + 1:i + 129], dtype='>u2')
+                    i += 129
+                else:
+                    values = np.frombuffer(segment[i + 1:i + 65], dtype=np.uint8)
+                    i += 65
+                table = np.zeros(64, dtype=np.int32)
+                table[ZIGZAG] = values
+                quant_tables[table_id] = table
+
+        elif marker == 0xC4:        # Huffman tables.
+            i = 0
+            while i < len(segment):
+                table_class, table_id = segment[i] >> 4, segment[i] & 0x0F
+                counts = segment[i + 1:i + 17]
+                total = sum(counts)
+                symbols = segment[i + 17:i + 17 + total]
+                huffman_tables[(table_class, table_id)] = build_huffman_table(
+                    counts, symbols)
+                i += 17 + total
+
+        elif marker == 0xDD:        # Restart interval.
+            restart_interval = (segment[0] << 8) | segment[1]
+
+        elif marker in SOF_SUPPORTED:
+            if segment[0] != 8:
+                return None
+            height = (segment[1] << 8) | segment[2]
+            width = (segment[3] << 8) | segment[4]
+            components = []
+            for c in range(segment[5]):
+                comp_id, sampling, table_id = segment[6 + c * 3:9 + c * 3]
+                components.append(
+                    (comp_id, sampling >> 4, sampling & 0x0F, table_id))
+            frame = (height, width, components)
+
+        elif marker in SOF_UNSUPPORTED or marker == 0xCC:
+            return None
+
+        elif marker == 0xDA:        # Start of scan.
+            if frame is None or height == 0:
+                return None
+            end = _SCAN_END.search(raw, pos)
+            end = end.start() if end else len(raw)
+            coefficients = _decode_scan(
+                segment, raw[pos:end], frame, quant_tables, huffman_tables,
+                restart_interval)
+            if coefficients is not None:
+                return coefficients
+            pos = end
+
+    return None
+
+
+def _decode_scan(header, data, frame, quant_tables, huffman_tables,
+                 restart_interval):
+    """Decode the luminance blocks in a scan.
+    Returns:
+        the coefficients as read_luma_coefficients does, or None if the scan
+        does not contain the luminance component.
+    """
+    height, width, components = frame
+    h_max = max(comp[1] for comp in components)
+    v_max = max(comp[2] for comp in components)
+    luma_id, luma_h, luma_v, luma_table = components[0]
+
+    # Components in this scan.
+    scan_components = []
+    for c in range(header[0]):
+        comp_id, table_ids = header[1 + c * 2:3 + c * 2]
+        for comp in components:
+            if comp[0] == comp_id:
+                scan_components.append((comp, table_ids >> 4, table_ids & 0x0F))
+    if luma_id not in [comp[0][0] for comp in scan_components]:
+        return None
+
+    # Block numbers of the luminance component, without the MCU padding.
+    luma_cols = -(-(-(-width * luma_h // h_max)) // 8)
+    luma_rows = -(-(-(-height * luma_v // v_max)) // 8)
+
+    if len(scan_components) == 1:
+        # A non-interleaved scan, one block in every MCU.
+        mcu_cols, mcu_rows = luma_cols, luma_rows
+        blocks = [1]
+        block_h, block_v = 1, 1
+    else:
+        mcu_cols = -(-width // (8 * h_max))
+        mcu_rows = -(-height // (8 * v_max))
+        blocks = [comp[1] * comp[2] for comp, _, _ in scan_components]
+        block_h, block_v = luma_h, luma_v
+
+    try:
+        dc_tables = [huffman_tables[(0, dc)] for _, dc, _ in scan_components]
+        ac_tables = [huffman_tables[(1, ac)] for _, _, ac in scan_components]
+        quant_table = quant_tables[luma_table]
+    except KeyError:
+        return None
+    store = [comp[0] == luma_id for comp, _, _ in scan_components]
+
+    # Split the data by restart markers and remove the stuffed zero bytes.
+    segments = [s.replace(b'\xff\x00', b'\xff') for s in _RESTART.split(data)]
+    mcu_total = mcu_cols * mcu_rows
+    interval = restart_interval or mcu_total
+
+    sink = []
+    try:
+        for index, segment in enumerate(segments):
+            mcu_count = min(interval, mcu_total - index * interval)
+            if mcu_count <= 0:
+                break
+            _decode_segment(segment, blocks, mcu_count, dc_tables, ac_tables,
+                            store, sink)
+    except IndexError:
+        # Truncated or corrupted data.
+        return None
+    if len(sink) != mcu_total * block_h * block_v:
+        return None
+
+    # Reorder the blocks from MCU order into raster order.
+    coefs = np.array(sink, dtype=np.int32)
+    coefs = coefs.reshape(mcu_rows, mcu_cols, block_v, block_h, 64)
+    coefs = coefs.transpose(0, 2, 1, 3, 4)
+    coefs = coefs.reshape(mcu_rows * block_v, mcu_cols * block_h, 64)
+    coefs = coefs[:luma_rows, :luma_cols]
+
+    # Zigzag to natural order, dequantize and undo the level shift.
+    natural = np.zeros_like(coefs)
+    natural[:, :, ZIGZAG] = coefs
+    natural *= quant_table
+    natural[:, :, 0] += DC_SHIFT
+
+    return natural.reshape(luma_rows, luma_cols, 8, 8)
+
+
+def main():
+    """The main entrance"""
+    parser = ArgumentParser()
+    parser.add_argument('file', type=str, help='the JPEG file to be read')
+    args = parser.parse_args()
+
+    coefficients = read_luma_coefficients(args.file)
+    if coefficients is None:
+        print("Not a supported JPEG file.")
+    else:
+        print("Luminance blocks: {}x{}".format(*coefficients.shape[:2]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,65 @@
 """Estimate head pose according to the facial landmarks"""
+import os
+
 import cv2
 import numpy as np
 
+# Parsed 3D models by file name, and camera matrices by image size. They are
+# shared by all estimators in the process and are read only.
+_MODEL_CACHE = {}
+_CAMERA_CACHE = {}
+
+# Assuming no lens distortion
+DIST_COEFFS = np.zeros((4, 1))
+DIST_COEFFS.setflags(write=False)
+
+
+def get_model_points(filename='assets/model.txt'):
+    """
+    Get all 68 3D model points from file. The model is parsed once per
+    process. A precompiled .npy file alongside, if not older than the text
+    file, is loaded instead of parsing the text.
+    """
+    if filename in _MODEL_CACHE:
+        return _MODEL_CACHE[filename]
+
+    npy_file = os.path.splitext(filename)[0] + '.npy'
+    if os.path.exists(npy_file) and \
+            os.path.getmtime(npy_file) >= os.path.getmtime(filename):
+        model_points = np.load(npy_file)
+    else:
+        model_points = np.loadtxt(filename, dtype=np.float32)
+        model_points = np.reshape(model_points, (3, -1)).T
+
+        # Transform the model into a front view.
+        model_points[:, 2] *= -1
+
+    model_points = np.ascontiguousarray(model_points, dtype=np.float32)
+    model_points.setflags(write=False)
+    _MODEL_CACHE[filename] = model_points
+    return model_points
+
+
+def compile_model(filename='assets/model.txt'):
+    """Save the parsed model as a .npy file alongside the text file."""
+    npy_file = os.path.splitext(filename)[0] + '.npy'
+    np.save(npy_file, get_model_points(filename))
+    return npy_file
+
+
+def get_camera_matrix(img_size):
+    """Get the camera matrix of an image size, shared across estimators."""
+    img_size = tuple(img_size)
+    if img_size not in _CAMERA_CACHE:
+        focal_length = img_size[1]
+        camera_matrix = np.array(
+            [[focal_length, 0, img_size[1] / 2],
+             [0, focal_length, img_size[0] / 2],
+             [0, 0, 1]], dtype="double")
+        camera_matrix.setflags(write=False)
+        _CAMERA_CACHE[img_size] = camera_matrix
+    return _CAMERA_CACHE[img_size]
+
 
 class PoseEstimator:
     """Estimate head pose according to the facial landmarks"""
@@ -24,13 +82,10 @@ class PoseEstimator:
         # Camera internals
         self.focal_length = self.size[1]
         self.camera_center = (self.size[1] / 2, self.size[0] / 2)
-        self.camera_matrix = np.array(
-            [[self.focal_length, 0, self.camera_center[0]],
-             [0, self.focal_length, self.camera_center[1]],
-             [0, 0, 1]], dtype="double")
+        self.camera_matrix = get_camera_matrix(self.size)
 
         # Assuming no lens distortion
-        self.dist_coeefs = np.zeros((4, 1))
+        self.dist_coeefs = DIST_COEFFS
 
         # Rotation vector and translation vector
         self.r_vec = np.array([[0.01891013], [0.08560084], [-3.14392813]])
@@ -41,17 +96,7 @@ class PoseEstimator:
 
     def _get_full_model_points(self, filename='assets/model.txt'):
         """Get all 68 3D model points from file"""
-        raw_value = []
-        with open(filename) as file:
-            for line in file:
-                raw_value.append(line)
-        model_points = np.array(raw_value, dtype=np.float32)
-        model_points = np.reshape(model_points, (3, -1)).T
-
-        # Transform the model into a front view.
-        model_points[:, 2] *= -1
-
-        return model_points
+        return get_model_points(filename)
 
     def show_3d_model(self):
         from matplotlib import pyplot
@@ -111,6 +156,114 @@ class PoseEstimator:
 
         return (rotation_vector, translation_vector)
 
+    def solve_pose_by_68_points_batch(self, image_points, iterations=15):
+        """
+        Solve the poses of a batch of faces at once by Levenberg-Marquardt
+        iterations minimizing the reprojection error, the same objective of
+        cv2.solvePnP. For faces both solvers converge on, the rotations agree
+        within 1e-5 rad and the translations within 1e-3.
+
+        Args:
+            image_points: (N, 68, 2) array of facial marks.
+            iterations: number of iterations.
+
+        Returns:
+            (rotation_vectors, translation_vectors) of shape (N, 3) each.
+        """
+        image_points = np.asarray(image_points, dtype=np.float64)
+        image_points = image_points.reshape(-1, 68, 2)
+        num = image_points.shape[0]
+        model = self.model_points_68.astype(np.float64)
+        fx, fy = self.camera_matrix[0, 0], self.camera_matrix[1, 1]
+        cx, cy = self.camera_matrix[0, 2], self.camera_matrix[1, 2]
+
+        # Start from the same extrinsic guess of solve_pose_by_68_points.
+        r_mats = np.tile(rodrigues_batch(self.r_vec.reshape(1, 3)), (num, 1, 1))
+        t_vecs = np.tile(self.t_vec.reshape(1, 3), (num, 1))
+        damping = np.full(num, 1e-3)
+
+        def _get_error(r_mats, t_vecs):
+            points = np.einsum('nij,kj->nki', r_mats, model) + t_vecs[:, None]
+            projected = np.stack(
+                [fx * points[..., 0] / points[..., 2] + cx,
+                 fy * points[..., 1] / points[..., 2] + cy], axis=-1)
+            return points, projected - image_points
+
+        points, error = _get_error(r_mats, t_vecs)
+        cost = np.square(error).sum(axis=(1, 2))
+
+        for _ in range(iterations):
+            # Jacobian of the projection by the camera points, (N, 68, 2, 3).
+            x, y, z = points[..., 0], points[..., 1], points[..., 2]
+            zeros = np.zeros_like(z)
+            d_proj = np.stack([
+                np.stack([fx / z, zeros, -fx * x / z ** 2], axis=-1),
+                np.stack([zeros, fy / z, -fy * y / z ** 2], axis=-1)], axis=-2)
+
+            # Jacobian of the camera points p = R * X + t by a small rotation
+            # w applied on the left is -[R * X]x, and by t is identity.
+            rotated = points - t_vecs[:, None]
+            r_x, r_y, r_z = rotated[..., 0], rotated[..., 1], rotated[..., 2]
+            skew = np.zeros(points.shape + (3,))
+            skew[..., 0, 1], skew[..., 0, 2] = r_z, -r_y
+            skew[..., 1, 0], skew[..., 1, 2] = -r_z, r_x
+            skew[..., 2, 0], skew[..., 2, 1] = r_y, -r_x
+            jacobian = np.concatenate(
+                [np.matmul(d_proj, skew), d_proj], axis=-1).reshape(num, -1, 6)
+
+            # Damped normal equations for all faces.
+            residual = error.reshape(num, -1)
+            hessian = np.matmul(jacobian.transpose(0, 2, 1), jacobian)
+            gradient = np.einsum('nki,nk->ni', jacobian, residual)
+            diagonal = np.einsum('nii->ni', hessian)
+            hessian = hessian + (damping[:, None] * diagonal)[..., None] * np.eye(6)
+            step = -np.linalg.solve(hessian, gradient[..., None])[..., 0]
+
+            new_r_mats = np.matmul(rodrigues_batch(step[:, :3]), r_mats)
+            new_t_vecs = t_vecs + step[:, 3:]
+            new_points, new_error = _get_error(new_r_mats, new_t_vecs)
+            new_cost = np.square(new_error).sum(axis=(1, 2))
+
+            # Accept the steps reducing the cost, and adjust the damping.
+            better = new_cost < cost
+            r_mats[better] = new_r_mats[better]
+            t_vecs[better] = new_t_vecs[better]
+            points[better] = new_points[better]
+            error[better] = new_error[better]
+            cost[better] = new_cost[better]
+            damping = np.where(better, damping / 10, damping * 10)
+
+        return rotation_to_vector_batch(r_mats), t_vecs
+
+    def get_euler_angles_batch(self, rotation_vectors):
+        """
+        Convert rotation vectors into Euler angles, the same as
+        cv2.decomposeProjectionMatrix does with the rotation matrices.
+
+        The roll axis is flipped by 180 degree, the same as the labels
+        generated by pts_tools.preview_json.
+
+        Args:
+            rotation_vectors: (N, 3) array.
+
+        Returns:
+            (N, 3) array of pitch, yaw and roll in degrees.
+        """
+        r_mats = rodrigues_batch(np.reshape(rotation_vectors, (-1, 3)))
+
+        # The rotation matrix is Rz(roll) * Ry(yaw) * Rx(pitch).
+        pitch = np.arctan2(r_mats[:, 2, 1], r_mats[:, 2, 2])
+        yaw = np.arcsin(np.clip(-r_mats[:, 2, 0], -1.0, 1.0))
+        roll = np.arctan2(r_mats[:, 1, 0], r_mats[:, 0, 0])
+        angles = np.degrees(np.stack([pitch, yaw, roll], axis=1))
+
+        # Flip the roll axis.
+        roll = angles[:, 2]
+        angles[:, 2] = np.where(roll > 0, 180 - roll,
+                                np.where(roll < 0, -(180 + roll), roll))
+
+        return angles
+
     def draw_annotation_box(self, image, rotation_vector, translation_vector, color=(255, 255, 255), line_width=2):
         """Draw a 3D box as annotation of pose"""
         point_3d = []
@@ -129,7 +282,7 @@ class PoseEstimator:
         point_3d.append((front_size, front_size, front_depth))
         point_3d.append((front_size, -front_size, front_depth))
         point_3d.append((-front_size, -front_size, front_depth))
-        point_3d = np.array(point_3d, dtype=np.float).reshape(-1, 3)
+        point_3d = np.array(point_3d, dtype=np.float64).reshape(-1, 3)
 
         # Map to 2d image points
         (point_2d, _) = cv2.projectPoints(point_3d,
@@ -154,13 +307,14 @@ class PoseEstimator:
 
         axisPoints, _ = cv2.projectPoints(
             points, R, t, self.camera_matrix, self.dist_coeefs)
+        axisPoints = axisPoints.reshape(-1, 2).astype(int).tolist()
 
-        img = cv2.line(img, tuple(axisPoints[3].ravel()), tuple(
-            axisPoints[0].ravel()), (255, 0, 0), 3)
-        img = cv2.line(img, tuple(axisPoints[3].ravel()), tuple(
-            axisPoints[1].ravel()), (0, 255, 0), 3)
-        img = cv2.line(img, tuple(axisPoints[3].ravel()), tuple(
-            axisPoints[2].ravel()), (0, 0, 255), 3)
+        img = cv2.line(img, tuple(axisPoints[3]), tuple(
+            axisPoints[0]), (255, 0, 0), 3)
+        img = cv2.line(img, tuple(axisPoints[3]), tuple(
+            axisPoints[1]), (0, 255, 0), 3)
+        img = cv2.line(img, tuple(axisPoints[3]), tuple(
+            axisPoints[2]), (0, 0, 255), 3)
 
     def get_pose_marks(self, marks):
         """Get marks ready for pose estimation from 68 marks"""
@@ -172,3 +326,179 @@ class PoseEstimator:
         pose_marks.append(marks[48])    # Mouth left corner
         pose_marks.append(marks[54])    # Mouth right corner
         return pose_marks
+
+
+class OneEuroFilter:
+    """
+    The one euro filter, a low pass filter whose cutoff frequency rises with
+    the speed of the signal: smooth when still, responsive when moving.
+    Casiez, G., Roussel, N. and Vogel, D. (2012). 1 Euro Filter.
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.last_value = None
+        self.last_derivative = None
+
+    @staticmethod
+    def _get_alpha(cutoff, interval):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / interval)
+
+    def filter(self, value, interval):
+        """Filter a new value, interval is the time since the last one."""
+        value = np.asarray(value, dtype=np.float64)
+        if self.last_value is None:
+            self.last_value = value
+            self.last_derivative = np.zeros_like(value)
+            return value
+
+        derivative = (value - self.last_value) / interval
+        alpha = self._get_alpha(self.d_cutoff, interval)
+        derivative = alpha * derivative + (1 - alpha) * self.last_derivative
+
+        cutoff = self.min_cutoff + self.beta * np.abs(derivative)
+        alpha = self._get_alpha(cutoff, interval)
+        value = alpha * value + (1 - alpha) * self.last_value
+
+        self.last_value = value
+        self.last_derivative = derivative
+        return value
+
+
+class PoseTracker:
+    """
+    Track the head poses of multiple faces in a video. Each track warm starts
+    the solver from its own last pose, so a few iterations of refinement are
+    enough, and smooths the output with a one euro filter.
+    """
+
+    def __init__(self, img_size=(480, 640), iterations=5, fps=30,
+                 min_cutoff=1.0, beta=0.05):
+        """
+        Initialize the tracker.
+        img_size: the size of the video frames.
+        iterations: the refinement iterations of a warm started solve.
+        fps: the frame rate, used when no timestamp is provided.
+        min_cutoff, beta: the parameters of the one euro filter.
+        """
+        self.estimator = PoseEstimator(img_size)
+        self.criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT,
+                         iterations, 1e-6)
+        self.interval = 1.0 / fps
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.tracks = {}
+
+    def update(self, track_id, image_points, timestamp=None):
+        """
+        Update a track with the 68 marks of a new frame.
+        Return the smoothed (rotation_vector, translation_vector) as pose.
+        """
+        image_points = np.asarray(image_points, dtype=np.float64).reshape(-1, 2)
+        model_points = self.estimator.model_points_68.astype(np.float64)
+        track = self.tracks.get(track_id)
+
+        if track is None:
+            (_, r_vec, t_vec) = cv2.solvePnP(
+                model_points, image_points, self.estimator.camera_matrix,
+                self.estimator.dist_coeefs,
+                rvec=self.estimator.r_vec.copy(),
+                tvec=self.estimator.t_vec.copy(),
+                useExtrinsicGuess=True)
+            track = {'r_vec': r_vec, 't_vec': t_vec, 'timestamp': timestamp,
+                     'filter': OneEuroFilter(self.min_cutoff, self.beta)}
+            self.tracks[track_id] = track
+        else:
+            r_vec, t_vec = cv2.solvePnPRefineLM(
+                model_points, image_points, self.estimator.camera_matrix,
+                self.estimator.dist_coeefs, track['r_vec'].copy(),
+                track['t_vec'].copy(), criteria=self.criteria)
+            # The same rotation may flip to another vector near pi.
+            r_vec = align_rotation_vector(r_vec, track['r_vec'])
+            track['r_vec'], track['t_vec'] = r_vec, t_vec
+
+        interval = self.interval
+        if timestamp is not None and track['timestamp'] is not None:
+            interval = max(timestamp - track['timestamp'], 1e-6)
+        track['timestamp'] = timestamp
+
+        pose = track['filter'].filter(np.vstack([r_vec, t_vec]), interval)
+        return (pose[:3], pose[3:])
+
+    def remove(self, track_id):
+        """Stop tracking a face."""
+        self.tracks.pop(track_id, None)
+
+
+def align_rotation_vector(rotation_vector, reference):
+    """
+    Rotation vectors r and r * (1 - 2 * pi / |r|) are the same rotation.
+    Return the one closer to the reference vector.
+    """
+    theta = np.linalg.norm(rotation_vector)
+    if theta < 1e-12:
+        return rotation_vector
+    other = rotation_vector * (1 - 2 * np.pi / theta)
+    if np.linalg.norm(other - reference) < np.linalg.norm(rotation_vector - reference):
+        return other
+    return rotation_vector
+
+
+def rodrigues_batch(rotation_vectors):
+    """
+    Convert rotation vectors into rotation matrices, like cv2.Rodrigues.
+    Args:
+        rotation_vectors: (N, 3) array.
+    Returns:
+        (N, 3, 3) array.
+    """
+    rotation_vectors = np.asarray(rotation_vectors, dtype=np.float64)
+    theta = np.linalg.norm(rotation_vectors, axis=1)
+    safe_theta = np.where(theta < 1e-12, 1.0, theta)
+    axis = rotation_vectors / safe_theta[:, None]
+
+    cross = np.zeros((len(axis), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2] = -axis[:, 2], axis[:, 1]
+    cross[:, 1, 0], cross[:, 1, 2] = axis[:, 2], -axis[:, 0]
+    cross[:, 2, 0], cross[:, 2, 1] = -axis[:, 1], axis[:, 0]
+
+    sin = np.sin(theta)[:, None, None]
+    cos = np.cos(theta)[:, None, None]
+    r_mats = np.eye(3) + sin * cross + (1 - cos) * np.matmul(cross, cross)
+    r_mats[theta < 1e-12] = np.eye(3)
+    return r_mats
+
+
+def rotation_to_vector_batch(r_mats):
+    """
+    Convert rotation matrices into rotation vectors, like cv2.Rodrigues.
+    Args:
+        r_mats: (N, 3, 3) array.
+    Returns:
+        (N, 3) array.
+    """
+    r_mats = np.asarray(r_mats, dtype=np.float64)
+    cos = np.clip((np.trace(r_mats, axis1=1, axis2=2) - 1) / 2, -1.0, 1.0)
+    theta = np.arccos(cos)
+    vectors = np.stack([r_mats[:, 2, 1] - r_mats[:, 1, 2],
+                        r_mats[:, 0, 2] - r_mats[:, 2, 0],
+                        r_mats[:, 1, 0] - r_mats[:, 0, 1]], axis=1)
+    sin = np.sin(theta)
+
+    # The general case.
+    scale = np.where(sin > 1e-6, theta / (2 * np.maximum(sin, 1e-6)), 0.5)
+    result = vectors * scale[:, None]
+
+    # Angles close to pi, where the vectors above vanish. The axis comes from
+    # the diagonal of (R + I) / 2 = a * a^T.
+    near_pi = (sin <= 1e-6) & (cos < 0)
+    for i in np.flatnonzero(near_pi):
+        outer = (r_mats[i] + np.eye(3)) / 2
+        column = np.argmax(np.diag(outer))
+        axis = outer[:, column] / np.sqrt(outer[column, column])
+        result[i] = axis * theta[i]
+
+    return result
@@ -4,14 +4,19 @@ This script shows how to read iBUG pts file and draw all the landmark points on
 
 import json
 import os
+import time
+from argparse import ArgumentParser
+from multiprocessing import Pool
 
 import cv2
 import numpy as np
 from tqdm import tqdm
 
+import box_tools as bt
 import face_detector as fd
 import pose_estimator as pe
 from file_list_generator import ListGenerator
+from image_index import ImageIndex
 
 IMAGE_DIR = "/data/landmark/image"
 MARK_DIR = "/data/landmark/mark68"
@@ -38,6 +43,65 @@ def read_points(file_name=None):
     return points
 
 
+def parse_points(file_name):
+    """
+    Read points from .pts file as a numpy array of shape (68, 2). All the
+    numbers between the braces are parsed at once.
+    """
+    with open(file_name) as file:
+        text = file.read()
+    body = text[text.index('{') + 1:text.rindex('}')]
+    points = np.array(body.split(), dtype=np.float32).reshape(-1, 2)
+    assert len(points) == 68, "The landmarks should contain 68 points."
+    return points
+
+
+def read_points_bulk(pts_files, cache_file=None, num_workers=None):
+    """
+    Read the points of many .pts files into one array of shape (N, 68, 2).
+
+    If cache_file is provided, the points are cached in it as a .npy file
+    with a .json index of the file paths, sizes and modification times. Only
+    the files changed since are parsed again, and an up to date cache is
+    returned as a read only memory map.
+    """
+    stats = [os.stat(f) for f in pts_files]
+    stats = [[s.st_size, s.st_mtime_ns] for s in stats]
+
+    cached = {}
+    if cache_file is not None:
+        index_file = os.path.splitext(cache_file)[0] + '.json'
+        if os.path.exists(cache_file) and os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+            if index['files'] == list(pts_files) and index['stats'] == stats:
+                return np.load(cache_file, mmap_mode='r')
+            points = np.load(cache_file, mmap_mode='r')
+            for i, (f, stat) in enumerate(zip(index['files'], index['stats'])):
+                cached[f] = (stat, i)
+
+    # Parse the new or changed files in parallel.
+    result = np.zeros((len(pts_files), 68, 2), dtype=np.float32)
+    to_parse = []
+    for i, (f, stat) in enumerate(zip(pts_files, stats)):
+        if f in cached and cached[f][0] == stat:
+            result[i] = points[cached[f][1]]
+        else:
+            to_parse.append(i)
+    if to_parse:
+        with Pool(num_workers) as pool:
+            parsed = pool.map(parse_points, [pts_files[i] for i in to_parse],
+                              chunksize=256)
+        result[to_parse] = parsed
+
+    if cache_file is not None:
+        np.save(cache_file, result)
+        with open(index_file, 'w') as f:
+            json.dump({'files': list(pts_files), 'stats': stats}, f)
+
+    return result
+
+
 def draw_landmark_point(image, points):
     """
     Draw landmark point on image.
@@ -250,40 +314,61 @@ def fit_box(box, image, points):
     return None
 
 
-def get_valid_box(image, points):
+def get_valid_box(image, points, cache=None):
     """
     Try to get a valid face box which meets the requirements.
     The function follows these steps:
         1. Try method 1, if failed:
         2. Try method 0, if failed:
         3. Return None
+    If a DetectionCache is provided, the face detection results are read
+    from it when available.
     """
+    # The minimal box of the points is shared by all the steps below.
+    min_box = get_minimal_box(points)
+
     # Try method 1 first.
-    def _get_positive_box(raw_boxes, points):
-        for box in raw_boxes:
-            # Move box down.
-            diff_height_width = (box[3] - box[1]) - (box[2] - box[0])
-            offset_y = int(abs(diff_height_width / 2))
-            box_moved = move_box(box, [0, offset_y])
-
-            # Make box square.
-            square_box = get_square_box(box_moved)
-
-            # Remove false positive boxes.
-            if points_in_box(points, square_box):
-                return square_box
-        return None
+    def _get_positive_box(confidences, raw_boxes):
+        """
+        Move all the boxes down, make them square and keep the ones
+        containing all the points, in one step. The one of the highest
+        confidence is chosen.
+        """
+        raw_boxes = np.asarray(raw_boxes, dtype=np.int64).reshape(-1, 4)
+        if len(raw_boxes) == 0:
+            return None
+
+        # Move boxes down.
+        diff_height_width = (raw_boxes[:, 3] - raw_boxes[:, 1]) - \
+            (raw_boxes[:, 2] - raw_boxes[:, 0])
+        offsets = np.zeros((len(raw_boxes), 2), dtype=np.int64)
+        offsets[:, 1] = np.abs(diff_height_width) // 2
+        boxes_moved = bt.move_box(raw_boxes, offsets)
+
+        # Make boxes square.
+        square_boxes = bt.get_square_box(boxes_moved)
+
+        # Remove false positive boxes.
+        positive = (square_boxes[:, :2] <= min_box[:2]).all(axis=1) & \
+            (square_boxes[:, 2:] >= min_box[2:]).all(axis=1)
+        if not positive.any():
+            return None
+        scores = np.where(positive, np.asarray(confidences), -np.inf)
+        return square_boxes[np.argmax(scores)].tolist()
 
     # Try to get a positive box from face detection results.
-    _, raw_boxes = fd.get_facebox(image, threshold=0.5)
-    positive_box = _get_positive_box(raw_boxes, points)
+    if cache is None:
+        confidences, raw_boxes = fd.get_facebox(
+            image, threshold=0.5, as_array=True)
+    else:
+        confidences, raw_boxes = cache.get_facebox(image, threshold=0.5)
+    positive_box = _get_positive_box(confidences, raw_boxes)
     if positive_box is not None:
         if box_in_image(positive_box, image) is True:
             return positive_box
         return fit_box(positive_box, image, points)
 
     # Method 1 failed, Method 0
-    min_box = get_minimal_box(points)
     sqr_box = get_square_box(min_box)
     epd_box = expand_box(sqr_box)
     if box_in_image(epd_box, image) is True:
@@ -291,9 +376,11 @@ def get_valid_box(image, points):
     return fit_box(epd_box, image, points)
 
 
-def preview(point_file):
+def preview(point_file, index=None):
     """
     Preview points on image.
+    index: an ImageIndex to find the image. If not provided, a .jpg and
+        then a .png image next to the point file is tried.
     """
     # Read the points from file.
     raw_points = read_points(point_file)
@@ -302,14 +389,20 @@ def preview(point_file):
     assert len(raw_points) == 68, "The landmarks should contain 68 points."
 
     # Read the image.
-    head, tail = os.path.split(point_file)
-    image_file = tail.split('.')[-2]
-    img_jpg = os.path.join(head, image_file + ".jpg")
-    img_png = os.path.join(head, image_file + ".png")
-    if os.path.exists(img_jpg):
-        img = cv2.imread(img_jpg)
+    if index is None:
+        head, tail = os.path.split(point_file)
+        image_file = tail.split('.')[-2]
+        img_jpg = os.path.join(head, image_file + ".jpg")
+        img_png = os.path.join(head, image_file + ".png")
+        if os.path.exists(img_jpg):
+            img = cv2.imread(img_jpg)
+        else:
+            img = cv2.imread(img_png)
     else:
-        img = cv2.imread(img_png)
+        image_file = index.get(point_file)
+        if image_file is None:
+            return None
+        img = cv2.imread(image_file)
 
     # Fast check: all points are in image.
     if points_are_valid(raw_points, img) is False:
@@ -351,9 +444,10 @@ def preview(point_file):
         exit()
 
 
-def preview_json(json_file):
+def preview_json(json_file, index=None):
     """
     Preview points on image.
+    index: an ImageIndex of IMAGE_DIR to find the image.
     """
     # Read the points from file.
     with open(json_file, 'r') as f:
@@ -366,9 +460,14 @@ def preview_json(json_file):
 
     # Read the image.
     _, tail = os.path.split(json_file)
-    image_file = tail.split('.')[-2]
-    img_jpg = os.path.join(IMAGE_DIR, image_file + ".jpg")
-    img = cv2.imread(img_jpg)
+    sample_name = tail.split('.')[-2]
+    if index is None:
+        image_file = os.path.join(IMAGE_DIR, sample_name + ".jpg")
+    else:
+        image_file = index.get(json_file, IMAGE_DIR)
+        if image_file is None:
+            return None
+    img = cv2.imread(image_file)
     img = cv2.resize(img, (PREVIEW_FACE_SIZE, PREVIEW_FACE_SIZE))
 
     # Fast check: all points are in image.
@@ -388,18 +487,9 @@ def preview_json(json_file):
     estimator.draw_axis(img, pose[0], pose[1])
     draw_landmark_point(img, marks)
 
-    # Solve the pitch, yaw and roll angels.
-    r_mat, _ = cv2.Rodrigues(pose[0])
-    p_mat = np.hstack((r_mat, np.array([[0], [0], [0]])))
-    _, _, _, _, _, _, u_angle = cv2.decomposeProjectionMatrix(p_mat)
-    pitch, yaw, roll = u_angle.flatten()
-
-    # I do not know why the roll axis seems flipted 180 degree. Manually by pass
-    # this issue.
-    if roll > 0:
-        roll = 180-roll
-    elif roll < 0:
-        roll = -(180 + roll)
+    # Solve the pitch, yaw and roll angels. The roll axis seems flipped 180
+    # degree, this is handled by the estimator.
+    pitch, yaw, roll = estimator.get_euler_angles_batch(pose[0])[0]
 
     # print("pitch: {:.2f}, yaw: {:.2f}, roll: {:.2f}".format(pitch, yaw, roll))
 
@@ -409,7 +499,7 @@ def preview_json(json_file):
         "yaw": yaw/180,
         "roll": roll/180
     }
-    pose_file_path = os.path.join(POSE_DIR, image_file + "-pose.json")
+    pose_file_path = os.path.join(POSE_DIR, sample_name + "-pose.json")
     with open(pose_file_path, 'w') as fid:
         json.dump(pose, fid)
 
@@ -423,30 +513,131 @@ def view_pts():
     # List all the files
     lg = ListGenerator()
     pts_file_list = lg.generate_list(MARK_DIR, ['pts'])
+    index = ImageIndex(MARK_DIR)
 
     # Show the image one by one.
     for file_name in pts_file_list:
-        preview(file_name)
+        preview(file_name, index)
 
 
 def view_json():
     # List all the files
     lg = ListGenerator()
     json_file_list = lg.generate_list(MARK_DIR, ['json'])
+    index = ImageIndex(IMAGE_DIR)
 
     # Show the image one by one.
     for file_name in tqdm(json_file_list):
-        preview_json(file_name)
+        preview_json(file_name, index)
+
+
+def _solve_pose_chunk(task):
+    """
+    Solve the poses of a chunk of landmark JSON files in a worker process.
+    Return the chunk index and the (N, 3) normalized pitch, yaw and roll.
+    Samples with points out of image are NaN.
+    """
+    chunk_index, json_files = task
+    marks = []
+    for json_file in json_files:
+        with open(json_file, 'r') as f:
+            marks.append(np.reshape(json.load(f), (-1, 2)))
+    marks = np.array(marks, dtype=np.float64) * PREVIEW_FACE_SIZE
+
+    # Fast check: all points are in image, the same as points_are_valid.
+    min_xy = np.trunc(marks.min(axis=1))
+    max_xy = np.trunc(marks.max(axis=1))
+    valid = (min_xy >= 0).all(axis=1) & (max_xy <= PREVIEW_FACE_SIZE).all(axis=1)
+
+    estimator = pe.PoseEstimator(
+        img_size=(PREVIEW_FACE_SIZE, PREVIEW_FACE_SIZE))
+    r_vecs, _ = estimator.solve_pose_by_68_points_batch(marks)
+    angles = estimator.get_euler_angles_batch(r_vecs) / 180
+    angles[~valid] = np.nan
+
+    return chunk_index, angles
+
+
+def export_poses(mark_dir=MARK_DIR, pose_dir=POSE_DIR, chunk_size=4096,
+                 num_workers=None):
+    """
+    Solve the poses of all landmark JSON files in mark_dir without any window,
+    and save them in pose_dir as:
+        poses.npy: (N, 3) float32 memory mappable pitch, yaw and roll, in the
+            same scale of the pose JSON files of preview_json.
+        poses.txt: the sample names, one per line in the order of poses.npy.
+        poses-done.npy: which samples are finished.
+    An interrupted export resumes from the unfinished samples, even with a
+    different chunk_size.
+    """
+    lg = ListGenerator()
+    json_file_list = sorted(lg.generate_list(mark_dir, ['json']))
+    names = [os.path.basename(f).split('.')[-2] for f in json_file_list]
+    chunks = [json_file_list[i:i + chunk_size]
+              for i in range(0, len(json_file_list), chunk_size)]
+
+    pose_file = os.path.join(pose_dir, "poses.npy")
+    name_file = os.path.join(pose_dir, "poses.txt")
+    done_file = os.path.join(pose_dir, "poses-done.npy")
+
+    # Resume only if the samples are exactly the same.
+    resume = False
+    if os.path.exists(pose_file) and os.path.exists(done_file) and \
+            os.path.exists(name_file):
+        with open(name_file) as f:
+            resume = f.read().splitlines() == names
+        resume = resume and \
+            np.load(done_file, mmap_mode='r').shape == (len(names),)
+
+    if resume:
+        poses = np.load(pose_file, mmap_mode='r+')
+        done = np.load(done_file, mmap_mode='r+')
+    else:
+        with open(name_file, 'w') as f:
+            f.writelines(name + '\n' for name in names)
+        poses = np.lib.format.open_memmap(
+            pose_file, mode='w+', dtype=np.float32, shape=(len(names), 3))
+        poses[:] = np.nan
+        done = np.lib.format.open_memmap(
+            done_file, mode='w+', dtype=bool, shape=(len(names),))
+
+    tasks = [(i, chunk) for i, chunk in enumerate(chunks)
+             if not done[i * chunk_size:(i + 1) * chunk_size].all()]
+    sample_num = sum(len(chunk) for _, chunk in tasks)
+    print("Samples: {}, to be solved: {}".format(len(names), sample_num))
+
+    start = time.perf_counter()
+    with Pool(num_workers) as pool:
+        for chunk_index, angles in tqdm(
+                pool.imap_unordered(_solve_pose_chunk, tasks), total=len(tasks)):
+            begin = chunk_index * chunk_size
+            poses[begin:begin + len(angles)] = angles
+            poses.flush()
+            done[begin:begin + len(angles)] = True
+            done.flush()
+
+    speed = sample_num / max(time.perf_counter() - start, 1e-6)
+    print("All done, {:.1f} samples/sec.".format(speed))
 
 
 def main():
     """
     The main entrance
     """
-    # You can..
-    # view_pts()
-    # or,
-    view_json()
+    parser = ArgumentParser()
+    parser.add_argument('--mode', type=str, default='view_json',
+                        choices=['view_pts', 'view_json', 'export_poses'],
+                        help='preview the marks, or export the poses headless')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes to export poses')
+    args = parser.parse_args()
+
+    if args.mode == 'view_pts':
+        view_pts()
+    elif args.mode == 'view_json':
+        view_json()
+    else:
+        export_poses(num_workers=args.workers)
 
 
 if __name__ == "__main__":